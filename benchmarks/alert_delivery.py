@@ -0,0 +1,149 @@
+"""
+Checks background alert delivery against a fake Slack webhook on localhost,
+and measures alert-to-delivery latency. The webhook can fail or stall
+requests; each scenario asserts every alert arrives exactly once.
+
+Scenarios:
+
+  * fast: the webhook answers immediately.
+  * flaky: the first request of each alert fails with a 500, and is retried.
+  * stalled: the first request of each alert outlasts the alerter timeout but
+    succeeds, as a slow SNS publish would. It must not be sent again.
+  * digest: alerts raised together are coalesced into one message.
+
+Usage: python alert_delivery.py [number of alerts]
+"""
+import sys
+import asyncio
+import requests
+from aiohttp import web
+from dsportal.alerters import SlackAlerter
+from dsportal.base import Index
+
+
+class FakeWebhook(object):
+    "Records posted texts; fails or stalls the first request of each text"
+
+    def __init__(self, mode=None, stall=0):
+        self.mode = mode
+        self.stall = stall
+        self.received = list()
+        self.seen = set()
+        self.requests = 0
+
+    async def handle(self, request):
+        text = (await request.json())["text"]
+        self.requests += 1
+
+        first = text not in self.seen
+        self.seen.add(text)
+
+        if first and self.mode == "flaky":
+            return web.Response(status=500)
+
+        self.received.append(text)
+
+        if first and self.mode == "stalled":
+            await asyncio.sleep(self.stall)
+
+        return web.Response(text="ok")
+
+
+class StallingSlackAlerter(SlackAlerter):
+    "HTTP timeout longer than the alerter timeout, like boto3 clients"
+
+    def send_alert(self, text, recipient=None):
+        r = requests.post(self.webhook_url, json={"text": text}, timeout=30)
+        r.raise_for_status()
+
+
+async def scenario(name, num, mode=None, digest_window=0):
+    stall = 0.35
+    webhook = FakeWebhook(mode, stall)
+    app = web.Application()
+    app.router.add_post("/hook", webhook.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    cls = StallingSlackAlerter if mode == "stalled" else SlackAlerter
+    alerter = cls(
+        webhook_url="http://127.0.0.1:%s/hook" % port,
+        name="alert delivery benchmark",
+        deploy_snooze=0,
+        concurrency=4,
+    )
+    # config accepts whole seconds only
+    alerter.timeout = 0.2
+    alerter.backoff = 0.1
+    alerter.digest_window = digest_window
+    deliver = asyncio.ensure_future(alerter.deliver())
+    await asyncio.sleep(0)
+
+    for n in range(num):
+        alerter.alert("check%s" % n, "check%s failed " % n, entity="entity")
+
+    expected = 1 if digest_window else num
+    for x in range(600):
+        if alerter.sent + alerter.failed >= expected and not alerter.pending:
+            break
+        await asyncio.sleep(0.05)
+
+    # a late duplicate would arrive within the stall
+    await asyncio.sleep(stall)
+
+    deliver.cancel()
+    await asyncio.gather(deliver, return_exceptions=True)
+    await runner.cleanup()
+
+    stats = alerter.stats()
+    assert stats["sent"] == expected and not stats["failed"], stats
+    assert len(webhook.received) == len(set(webhook.received)) == expected, (
+        len(webhook.received),
+        len(set(webhook.received)),
+    )
+    if mode:
+        assert stats["retried"] == num, stats
+
+    print(
+        name,
+        {
+            "alerts": num,
+            "messages": len(webhook.received),
+            "requests": webhook.requests,
+            "retried": stats["retried"],
+            "p50_latency_le": alerter.latency.quantile(0.5),
+            "max_latency": round(stats["max_latency"], 3),
+        },
+    )
+    return alerter
+
+
+def check_metrics(alerter):
+    "Delivery latency is exported at /metrics"
+    index = Index("alert delivery benchmark")
+    index.alerters.append(alerter)
+    text = index.metrics.render(index).decode()
+    assert (
+        'dsportal_alerts_delivery_seconds_count{alerter="SlackAlerter"} %s'
+        % alerter.sent
+        in text
+    ), text
+
+
+async def main(num):
+    alerter = await scenario("fast", num)
+    await scenario("flaky", num, "flaky")
+    await scenario("stalled", min(num, 4), "stalled")
+    await scenario("digest", num, digest_window=0.2)
+
+    check_metrics(alerter)
+    print("All assertions passed")
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
+    )
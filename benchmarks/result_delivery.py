@@ -0,0 +1,117 @@
+"""
+Measures idle CPU usage and enqueue-to-result latency of the local Worker,
+comparing event-driven result delivery against the previous 10ms polling loop.
+
+Usage: python result_delivery.py [idle seconds] [number of checks]
+"""
+import sys
+import asyncio
+import queue
+from time import monotonic, process_time, sleep
+from statistics import median
+from dsportal.base import Worker
+from dsportal import __version__ as version
+
+
+class ItemExpired(Exception):
+    def __init__(self, item, *args, **kwargs):
+        super(ItemExpired, self).__init__(*args, **kwargs)
+        self.item = item
+
+
+class TTLQueue(queue.Queue):
+    "Result queue of the polling worker, formerly dsportal.util.TTLQueue"
+
+    def __init__(self, *args, ttl=5, **kwargs):
+        super(TTLQueue, self).__init__(*args, **kwargs)
+        self.ttl = ttl
+
+    def put_nowait(self, item):
+        expiry = monotonic() + self.ttl
+        super(TTLQueue, self).put((item, expiry), block=False)
+
+    def get_nowait(self):
+        item, expiry = super(TTLQueue, self).get(block=False)
+
+        if monotonic() > expiry:
+            self.task_done()
+            raise ItemExpired(item)
+
+        return item
+
+
+class PollingWorker(Worker):
+    "Worker with the result path used before event-driven delivery"
+
+    def __init__(self):
+        super(PollingWorker, self).__init__()
+        self.result_queue = TTLQueue(maxsize=1000, ttl=5)
+
+    def _put_result(self, id, result):
+        self.result_queue.put_nowait((id, result))
+
+    async def read_results(self, callback):
+        while True:
+            try:
+                while True:
+                    response = self.result_queue.get_nowait()
+                    callback(response)
+            except queue.Empty:
+                pass
+            except ItemExpired:
+                pass
+
+            await asyncio.sleep(0.01)
+
+
+async def measure(worker, idle_seconds, num_checks):
+    sent = dict()
+    latencies = list()
+    done = asyncio.Event()
+
+    def callback(response):
+        id, result = response
+        latencies.append(monotonic() - sent.pop(id))
+        if not sent:
+            done.set()
+
+    task = asyncio.ensure_future(worker.read_results(callback))
+
+    cpu = process_time()
+    await asyncio.sleep(idle_seconds)
+    idle_cpu = (process_time() - cpu) / idle_seconds * 100
+
+    for x in range(num_checks):
+        id = str(x)
+        sent[id] = monotonic()
+        worker.enqueue("WorkerVersion", id, server_version=version)
+        # one at a time, so latency is not dominated by queueing
+        await asyncio.sleep(0.005)
+
+    await asyncio.wait_for(done.wait(), 10)
+    task.cancel()
+
+    latencies.sort()
+    return {
+        "idle_cpu_percent": round(idle_cpu, 2),
+        "latency_median_ms": round(median(latencies) * 1000, 3),
+        "latency_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+        "latency_max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+def main():
+    idle_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    num_checks = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    loop = asyncio.get_event_loop()
+
+    for name, cls in (("polling", PollingWorker), ("event-driven", Worker)):
+        worker = cls()
+        worker.start(loop=loop)
+        stats = loop.run_until_complete(measure(worker, idle_seconds, num_checks))
+        print(name, stats)
+
+
+if __name__ == "__main__":
+    main()
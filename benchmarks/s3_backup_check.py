@@ -0,0 +1,103 @@
+"""
+Checks S3BackupChecker against an in-process S3 (moto) and compares the cost
+of full, incremental and date-partitioned listings of a bucket with many
+backups. Asserts the results are correct, and that the incremental listing
+cache forgets prefixes after S3_LISTING_TTL.
+
+Requires moto. Nothing leaves the process.
+
+Usage: python s3_backup_check.py [number of existing backups]
+"""
+import os
+import sys
+import time
+from time import strftime, gmtime
+
+# moto refuses to start without credentials; these never leave the process
+for var in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+    os.environ.setdefault(var, "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from moto import mock_aws
+from dsportal import healthchecks
+from dsportal.healthchecks import S3BackupChecker
+from dsportal.util import get_boto3_client
+
+BUCKET = "backups"
+TEMPLATE = "%Y/%m/%d/"
+
+
+def count_list_calls(client):
+    "Returns a dict whose 'calls' counts ListObjectsV2 requests"
+    counter = {"calls": 0}
+
+    def count(**kwargs):
+        counter["calls"] += 1
+
+    client.meta.events.register("before-call.s3.ListObjectsV2", count)
+    return counter
+
+
+def timed(counter, **kwargs):
+    counter["calls"] = 0
+    start = time.perf_counter()
+    result = S3BackupChecker.run_check(bucket=BUCKET, **kwargs)
+    return result, counter["calls"], round(time.perf_counter() - start, 3)
+
+
+def main(num):
+    client = get_boto3_client("s3")
+    client.create_bucket(Bucket=BUCKET)
+    counter = count_list_calls(client)
+
+    # old backups sort before today's partition, as date-partitioned keys do
+    for n in range(num):
+        client.put_object(Bucket=BUCKET, Key="db/2000/01/01/%06d.sql.gz" % n, Body=b"")
+
+    result, calls, seconds = timed(counter, prefix="db/", age="1h")
+    assert result["healthy"], result
+    print("full", {"list_calls": calls, "seconds": seconds})
+
+    result, calls, seconds = timed(counter, prefix="db/", age="1h", incremental=True)
+    assert result["healthy"], result
+    print("incremental, first", {"list_calls": calls, "seconds": seconds})
+
+    result, calls, seconds = timed(counter, prefix="db/", age="1h", incremental=True)
+    assert result["healthy"] and calls == 1, (result, calls)
+    print("incremental, unchanged", {"list_calls": calls, "seconds": seconds})
+
+    # a backup too old for a 1 second age fails, a new one is found
+    time.sleep(2)
+    result, calls, seconds = timed(counter, prefix="db/", age="1s", incremental=True)
+    assert not result["healthy"], result
+
+    today = "db/" + strftime(TEMPLATE, gmtime())
+    client.put_object(Bucket=BUCKET, Key=today + "new.sql.gz", Body=b"")
+
+    result, calls, seconds = timed(counter, prefix="db/", age="1s", incremental=True)
+    assert result["healthy"] and calls == 1, (result, calls)
+    print("incremental, new backup", {"list_calls": calls, "seconds": seconds})
+
+    result, calls, seconds = timed(
+        counter, prefix="db/", age="1h", key_template=TEMPLATE
+    )
+    assert result["healthy"], result
+    print("partitioned", {"list_calls": calls, "seconds": seconds})
+
+    result, calls, seconds = timed(counter, prefix="empty/", age="1h")
+    assert not result["healthy"] and result["reason"] == "No backups found"
+
+    # prefixes not listed within S3_LISTING_TTL are forgotten
+    assert len(healthchecks._s3_listings) == 1
+    ttl, healthchecks.S3_LISTING_TTL = healthchecks.S3_LISTING_TTL, 0
+    time.sleep(0.01)
+    timed(counter, prefix="other/", age="1h", incremental=True)
+    healthchecks.S3_LISTING_TTL = ttl
+    assert list(k[1] for k in healthchecks._s3_listings) == ["other/"]
+
+    print("All assertions passed")
+
+
+if __name__ == "__main__":
+    with mock_aws():
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,243 @@
+"""
+Measures how the server scales with the number of healthchecks: dispatch
+throughput, result ingest latency, tab render time and resident memory of an
+Index with synthetic entities, using a local worker that runs nothing.
+
+Each size runs in a fresh process so memory figures are independent. Results
+are written as JSON to compare runs across commits.
+
+Usage: python server_scale.py [healthchecks, eg 1000,10000,100000] [output.json]
+"""
+import sys
+import json
+import gc
+import subprocess
+import platform
+from os import path
+from time import perf_counter
+from statistics import median
+from random import random
+
+# healthchecks per entity, entities per tab
+CHECKS_PER_ENTITY = 10
+ENTITIES_PER_TAB = 50
+
+# share of results that change health, so regrouping and deltas are exercised
+FLIP_RATE = 0.05
+
+SCRIPT_DIR = path.dirname(path.realpath(__file__))
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class FakeWorker(object):
+    "Stands in for the local Worker, remembering what was enqueued"
+
+    def __init__(self):
+        self.enqueued = list()
+
+    def enqueue(self, cls, id, priority=0, **kwargs):
+        self.enqueued.append(id)
+
+    def stats(self):
+        return {"drops": {}}
+
+
+def build_index(num_checks):
+    from dsportal.base import Index
+
+    index = Index("benchmark", worker_config={"min_threads": 1, "max_threads": 1})
+    index.local_worker = FakeWorker()
+
+    for e in range(num_checks // CHECKS_PER_ENTITY):
+        index.instantiate_entity(
+            cls="Host",
+            name="host%s.example.com" % e,
+            tab="tab%s" % (e // ENTITIES_PER_TAB),
+            healthchecks=[
+                {"cls": cls, "label": "%s %s" % (cls, c)}
+                for c, cls in zip(
+                    range(CHECKS_PER_ENTITY),
+                    ["RamUsage", "CpuUsage", "DiskUsage", "Uptime", "CpuTemperature"]
+                    * 2,
+                )
+            ],
+        )
+
+    return index
+
+
+def result(healthy):
+    return {
+        "healthy": healthy,
+        "value": "3.2 GB",
+        "bytes": 3200000000,
+        "bar_min": "0 GB",
+        "bar_max": "8.3 GB",
+        "bar_percent": 38,
+        "reason": "RAM usage nominal",
+    }
+
+
+def measure_renders(index):
+    """Cold render and compression time of the first entity tab and the
+    healthchecks tab"""
+    import aiohttp_jinja2
+    import jinja2
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import make_mocked_request
+    from dsportal import server
+    from dsportal.util import human_seconds
+
+    server.USER_CONFIG = {"name": "benchmark"}
+
+    app = web.Application()
+    aiohttp_jinja2.setup(
+        app,
+        loader=jinja2.FileSystemLoader(
+            path.join(SCRIPT_DIR, "..", "dsportal", "templates")
+        ),
+        filters={"human_seconds": human_seconds},
+    )
+    app["index"] = index
+    app["render_cache"] = dict()
+
+    loop = asyncio.get_event_loop()
+    times = dict()
+
+    # the healthchecks tab takes seconds beyond 10k healthchecks
+    repeat = 3 if len(index.healthchecks) <= 10000 else 1
+
+    first = next(iter(index.entities_by_tab))
+    for tab in (first, "healthchecks"):
+        samples = list()
+        for x in range(repeat):
+            # invalidate the render cache of both tabs
+            index._changed(index.entities_by_tab[first][0].healthchecks[0])
+            request = make_mocked_request(
+                "GET",
+                "/" + tab,
+                headers={"Accept-Encoding": "gzip, deflate, br"},
+                app=app,
+                match_info={"tab": tab},
+            )
+            start = perf_counter()
+            response = loop.run_until_complete(server.tab_handler(request))
+            samples.append(perf_counter() - start)
+
+        key = "healthchecks" if tab == "healthchecks" else "entity_tab"
+        times[key + "_render_ms"] = round(median(samples) * 1000, 2)
+        times[key + "_bytes"] = len(response.body)
+
+    return times
+
+
+def run(num_checks):
+    # imported before measuring memory of the index itself
+    import dsportal.base
+    import dsportal.entities
+    import dsportal.healthchecks
+
+    gc.collect()
+    rss = rss_bytes()
+
+    start = perf_counter()
+    index = build_index(num_checks)
+    build_seconds = perf_counter() - start
+
+    gc.collect()
+    index_bytes = rss_bytes() - rss
+
+    # dispatch every healthcheck, as the scheduler would when they fall due
+    start = perf_counter()
+    for h in index.healthchecks:
+        index._dispatch_check(h)
+    dispatch_seconds = perf_counter() - start
+
+    # two rounds of results: the first moves everything out of unknown
+    latencies = list()
+    for n in range(2):
+        for id in index.local_worker.enqueued:
+            r = result(True if n == 0 else random() > FLIP_RATE)
+            start = perf_counter()
+            index.dispatch_result(id, r)
+            latencies.append(perf_counter() - start)
+
+    latencies = latencies[len(latencies) // 2 :]
+    latencies.sort()
+
+    stats = {
+        "healthchecks": len(index.healthchecks),
+        "entities": len(index.entities),
+        "tabs": len(index.entities_by_tab),
+        "build_seconds": round(build_seconds, 3),
+        "dispatches_per_second": int(len(index.healthchecks) / dispatch_seconds),
+        "results_per_second": int(len(latencies) / sum(latencies)),
+        "result_latency_median_us": round(median(latencies) * 1e6, 2),
+        "result_latency_p99_us": round(percentile(latencies, 0.99) * 1e6, 2),
+        "result_latency_max_us": round(latencies[-1] * 1e6, 2),
+        "index_rss_bytes": index_bytes,
+        "rss_bytes_per_healthcheck": int(index_bytes / len(index.healthchecks)),
+    }
+
+    stats.update(measure_renders(index))
+    stats["peak_rss_bytes"] = rss_bytes()
+
+    return stats
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=SCRIPT_DIR,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--one":
+        num_checks = int(sys.argv[2])
+        # dsportal.config reads a config file from argv on import
+        del sys.argv[1:]
+        print(json.dumps(run(num_checks)))
+        return
+
+    sizes = sys.argv[1] if len(sys.argv) > 1 else "1000,10000,100000"
+    output = sys.argv[2] if len(sys.argv) > 2 else None
+
+    results = list()
+    for size in sizes.split(","):
+        out = subprocess.check_output([sys.executable, __file__, "--one", size])
+        results.append(json.loads(out.decode().strip().splitlines()[-1]))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
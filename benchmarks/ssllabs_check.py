@@ -0,0 +1,141 @@
+"""
+Checks SsllabsReport against a stubbed SSL Labs analyze API on localhost.
+Asserts concurrent checks of a host share one scan, reports are reused until
+max_age, rate limiting is waited out, and errors, timeouts and cancelled
+checks are handled. Reports the number of API requests per scenario.
+
+Usage: python ssllabs_check.py [concurrent checks per host]
+"""
+import sys
+import asyncio
+import aiohttp
+from aiohttp import web
+from dsportal import healthchecks
+from dsportal.healthchecks import SsllabsReport
+
+# seconds between polls; the API asks for 10
+POLL = 0.01
+
+
+class FakeAnalyzeApi(object):
+    """Scans of a host are IN_PROGRESS for `polls` requests, then READY with
+    the grade given by the host name, eg b.example.com -> B. Hosts starting
+    busy are rate limited on their first request, error never finish."""
+
+    def __init__(self, polls=5):
+        self.polls = polls
+        self.requests = 0
+        self.scans_started = 0
+        # host -> polls so far
+        self.scans = dict()
+        self.busy = set()
+
+    async def handle(self, request):
+        self.requests += 1
+        host = request.query["host"]
+
+        if host.startswith("busy") and host not in self.busy:
+            self.busy.add(host)
+            return web.Response(status=429)
+
+        if host not in self.scans:
+            assert request.query.get("fromCache") == "on", request.query
+            self.scans_started += 1
+            self.scans[host] = 0
+
+        self.scans[host] += 1
+
+        if host.startswith("error"):
+            return web.json_response(
+                {"status": "ERROR", "statusMessage": "Unable to resolve domain name"}
+            )
+
+        if host.startswith("slow") or self.scans[host] < self.polls:
+            return web.json_response({"status": "IN_PROGRESS", "host": host})
+
+        grade = host.split(".")[0].replace("busy-", "").upper().replace("PLUS", "+")
+        return web.json_response(
+            {"status": "READY", "host": host, "endpoints": [{"grade": grade}]}
+        )
+
+
+async def scenario(name, api, session, host, num, **kwargs):
+    api.requests = 0
+    api.scans_started = 0
+
+    checks = [
+        asyncio.ensure_future(
+            SsllabsReport.run_check_async(session, host=host, poll=POLL, **kwargs)
+        )
+        for x in range(num)
+    ]
+    results = await asyncio.gather(*checks, return_exceptions=True)
+
+    print(
+        name,
+        {
+            "checks": num,
+            "requests": api.requests,
+            "scans_started": api.scans_started,
+            "result": results[0],
+        },
+    )
+    return results
+
+
+async def main(num):
+    api = FakeAnalyzeApi()
+    app = web.Application()
+    app.router.add_get("/analyze", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    SsllabsReport.api = "http://127.0.0.1:%s/analyze" % port
+
+    async with aiohttp.ClientSession() as session:
+        results = await scenario("shared scan", api, session, "aplus.example.com", num)
+        assert all(r["healthy"] and r["value"] == "A+" for r in results), results
+        assert api.scans_started == 1 and api.requests == api.polls, api.requests
+
+        results = await scenario("cached", api, session, "aplus.example.com", num)
+        assert all(r["healthy"] for r in results) and api.requests == 0
+
+        results = await scenario("poor grade", api, session, "b.example.com", 1)
+        assert results[0]["healthy"] is False and results[0]["value"] == "B"
+
+        results = await scenario(
+            "rate limited", api, session, "busy-aplus.example.com", 1
+        )
+        assert results[0]["healthy"] and api.requests == api.polls + 1
+
+        results = await scenario("error", api, session, "error.example.com", num)
+        assert all(r["healthy"] is None for r in results), results
+        assert "resolve" in results[0]["reason"] and api.requests == 1
+
+        results = await scenario(
+            "timeout", api, session, "slow.example.com", 1, timeout="1s"
+        )
+        assert results[0]["healthy"] is None, results
+
+        # a cancelled check does not cancel the scan other checks wait for
+        first = asyncio.ensure_future(
+            SsllabsReport.run_check_async(session, host="a.example.com", poll=POLL)
+        )
+        second = asyncio.ensure_future(
+            SsllabsReport.run_check_async(session, host="a.example.com", poll=POLL)
+        )
+        await asyncio.sleep(POLL)
+        first.cancel()
+        assert (await second)["healthy"] is False
+        assert not healthchecks._ssllabs_polls
+
+    await runner.cleanup()
+    print("All assertions passed")
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
+    )
@@ -0,0 +1,458 @@
+"""
+Simulated fleet of remote workers, to size a server. Starts a dsportal server
+on localhost with a generated config, then opens one authenticated binary
+protocol websocket per simulated worker. Each dispatched check is answered
+with a synthetic result after a latency drawn from a distribution; nothing is
+checked.
+
+Reported, over the measurement window after warm up:
+
+  * dispatch-to-result latency, end to end: from the server dispatching a
+    check to its result reaching Index.receive_result, from the server's
+    dsportal_result_seconds histogram. Percentiles are interpolated within
+    buckets, as Prometheus histogram_quantile does.
+  * worker dispatch-to-send latency: from the DISPATCH frame arriving at the
+    worker to the result frame being written to the socket. Includes the
+    synthetic latency, result batching and backpressure from a busy server.
+  * dispatch lateness: how much later than its interval the server sent each
+    repeat dispatch of a check. Grows when the server falls behind.
+  * results sent by the fleet and accepted by the server, from /metrics.
+  * server and fleet CPU, as a percentage of one core.
+
+The server runs with its default config, so history and snapshots are on.
+
+Latency distributions, in milliseconds: fixed:MS, uniform:MIN:MAX, exp:MEAN,
+lognormal:MEDIAN:SIGMA.
+
+Usage: python worker_fleet.py [--workers 100] [--checks 100] [--interval 10]
+    [--latency lognormal:50:1] [--failures 0.01] [--duration 60] [output.json]
+"""
+import sys
+import os
+import json
+import math
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from os import path
+from time import monotonic
+from collections import defaultdict
+import aiohttp
+import yaml
+from dsportal import protocol
+
+SCRIPT_DIR = path.dirname(path.realpath(__file__))
+
+# the server delays the first dispatch to remote workers by 12 seconds, then
+# spreads checks over up to one interval
+INITIAL_DELAY = 12
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def latency_distribution(spec):
+    "Returns a function returning a latency in seconds from a spec in ms"
+    kind, _, args = spec.partition(":")
+    args = [float(a) for a in args.split(":") if a]
+
+    if kind == "fixed" and len(args) == 1:
+        return lambda: args[0] / 1000
+    if kind == "uniform" and len(args) == 2:
+        return lambda: random.uniform(args[0], args[1]) / 1000
+    if kind == "exp" and len(args) == 1:
+        return lambda: random.expovariate(1000 / args[0])
+    if kind == "lognormal" and len(args) == 2:
+        mu = math.log(args[0] / 1000)
+        return lambda: random.lognormvariate(mu, args[1])
+
+    raise ValueError("Unknown latency distribution %s" % spec)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(directory, port, workers, checks, interval):
+    "Returns {worker name: token}"
+    tokens = {"fleet%s" % w: "token%s" % w for w in range(workers)}
+
+    entities = list()
+    for w, worker in enumerate(tokens):
+        for e in range(math.ceil(checks / 10)):
+            entities.append(
+                {
+                    "cls": "Host",
+                    "name": "%s-host%s" % (worker, e),
+                    "tab": "fleet%s" % (w // 10),
+                    "worker": worker,
+                    "healthchecks": [
+                        {
+                            "cls": "Uptime",
+                            "label": "Uptime %s" % c,
+                            "interval": interval,
+                        }
+                        for c in range(min(10, checks - e * 10))
+                    ],
+                }
+            )
+
+    config = {
+        "name": "worker fleet benchmark",
+        "port": port,
+        "workers": tokens,
+        "entities": entities,
+    }
+
+    with open(path.join(directory, "config.yml"), "w") as f:
+        yaml.safe_dump(config, f)
+
+    # served by the server, relative to the config, as are history and
+    # snapshots
+    os.mkdir(path.join(directory, "assets"))
+
+    return tokens
+
+
+def process_cpu_seconds(pid):
+    with open("/proc/%s/stat" % pid) as f:
+        # comm may contain spaces; utime and stime are fields 14 and 15
+        fields = f.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def process_rss_bytes(pid):
+    with open("/proc/%s/statm" % pid) as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+async def scrape_results(session, url):
+    """Results accepted from, and checks dispatched to, the fleet, and the
+    dispatch to result histogram summed over the fleet"""
+    async with session.get(url) as resp:
+        text = await resp.text()
+
+    totals = defaultdict(float)
+    for line in text.splitlines():
+        name, _, rest = line.partition("{")
+        if 'worker="fleet' not in rest:
+            continue
+
+        value = float(line.rpartition(" ")[2])
+        if name == "dsportal_result_seconds_bucket":
+            totals[float(rest.partition('le="')[2].partition('"')[0])] += value
+        else:
+            totals[name] += value
+
+    return totals
+
+
+def summarise_histogram(before, after, scale=1000):
+    "Mean and percentiles interpolated within buckets, in milliseconds"
+    count = (
+        after["dsportal_result_seconds_count"] - before["dsportal_result_seconds_count"]
+    )
+    if not count:
+        return {}
+
+    # cumulative counts by upper bound
+    buckets = sorted((le, after[le] - before[le]) for le in after if type(le) == float)
+    total = after["dsportal_result_seconds_sum"] - before["dsportal_result_seconds_sum"]
+
+    def quantile(q):
+        lower, below = 0, 0
+        for le, n in buckets:
+            if n >= q * count:
+                if le == float("inf"):
+                    return round(lower * scale, 2)
+                share = (q * count - below) / (n - below)
+                return round((lower + (le - lower) * share) * scale, 2)
+            lower, below = le, n
+
+    return {
+        "mean": round(total / count * scale, 2),
+        "median": quantile(0.5),
+        "p90": quantile(0.9),
+        "p99": quantile(0.99),
+        "p999": quantile(0.999),
+    }
+
+
+class SimulatedWorker(object):
+    "One worker connection, answering dispatches with synthetic results"
+
+    def __init__(self, fleet, name, token):
+        self.fleet = fleet
+        self.name = name
+        self.token = token
+        # healthcheck number -> monotonic time of the last dispatch
+        self.dispatched = dict()
+
+    async def run(self, session, url):
+        headers = {
+            "Authorization": "Token " + self.token,
+            protocol.PROTOCOL_HEADER: str(protocol.VERSION),
+        }
+
+        async with session.ws_connect(url, headers=headers, heartbeat=10) as ws:
+            loop = asyncio.get_event_loop()
+
+            async def send_results(items):
+                await ws.send_bytes(
+                    protocol.encode_results([(n, r) for n, r, t in items])
+                )
+                self.fleet.sent(items)
+
+            batcher = protocol.Batcher(send_results)
+
+            try:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.BINARY:
+                        continue
+
+                    kind, records = protocol.decode(msg.data)
+
+                    if kind != protocol.DISPATCH:
+                        continue
+
+                    received = monotonic()
+                    for number in records:
+                        self.fleet.dispatched(self, number, received)
+                        loop.call_later(
+                            self.fleet.latency(),
+                            self._answer,
+                            batcher,
+                            number,
+                            received,
+                        )
+            finally:
+                batcher.close()
+
+    def _answer(self, batcher, number, received):
+        healthy = random.random() >= self.fleet.failures
+        result = {
+            "healthy": healthy,
+            "value": "12 days",
+            "reason": "" if healthy else "Synthetic failure",
+        }
+        if not batcher.add((number, result, received)):
+            self.fleet.refused += 1
+
+
+class Fleet(object):
+    def __init__(self, latency, failures, interval):
+        self.latency = latency
+        self.failures = failures
+        self.interval = interval
+        self.measuring = False
+        self.latencies = list()
+        self.lateness = list()
+        self.results = 0
+        self.refused = 0
+
+    def dispatched(self, worker, number, received):
+        previous = worker.dispatched.get(number)
+        worker.dispatched[number] = received
+
+        if self.measuring and previous:
+            self.lateness.append(received - previous - self.interval)
+
+    def sent(self, items):
+        if not self.measuring:
+            return
+
+        now = monotonic()
+        self.results += len(items)
+        self.latencies.extend(now - received for n, r, received in items)
+
+    def start(self):
+        self.measuring = True
+        self.latencies = list()
+        self.lateness = list()
+        self.results = 0
+        self.refused = 0
+
+
+async def wait_for_server(session, url, server, log_file):
+    for x in range(300):
+        if server.poll() is not None:
+            with open(log_file) as f:
+                log = f.read()[-2000:]
+            raise RuntimeError("Server exited with %s:\n%s" % (server.returncode, log))
+        try:
+            async with session.get(url):
+                return
+        except aiohttp.ClientConnectorError:
+            await asyncio.sleep(0.1)
+
+    raise RuntimeError("Server did not start")
+
+
+def summarise(values, scale=1000):
+    "Percentiles in milliseconds"
+    if not values:
+        return {}
+
+    values.sort()
+    return {
+        "median": round(percentile(values, 0.5) * scale, 2),
+        "p90": round(percentile(values, 0.9) * scale, 2),
+        "p99": round(percentile(values, 0.99) * scale, 2),
+        "p999": round(percentile(values, 0.999) * scale, 2),
+        "max": round(values[-1] * scale, 2),
+    }
+
+
+async def run(args, server, log_file, tokens, base_url):
+    fleet = Fleet(latency_distribution(args.latency), args.failures, args.interval)
+    workers = [SimulatedWorker(fleet, name, token) for name, token in tokens.items()]
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_for_server(session, base_url + "/metrics", server, log_file)
+
+        tasks = [
+            asyncio.ensure_future(w.run(session, base_url + "/worker-websocket"))
+            for w in workers
+        ]
+
+        # every check has been dispatched at least once after the warm up
+        warmup = INITIAL_DELAY + min(args.interval, 60) + 2
+        print("Warming up for %ss" % warmup, file=sys.stderr)
+        await asyncio.sleep(warmup)
+
+        failed = [t for t in tasks if t.done()]
+        if failed:
+            raise RuntimeError(
+                "%s workers disconnected: %s" % (len(failed), failed[0].exception())
+            )
+
+        before = await scrape_results(session, base_url + "/metrics")
+        server_cpu = process_cpu_seconds(server.pid)
+        fleet_cpu = sum(os.times()[:2])
+        fleet.start()
+        start = monotonic()
+
+        print("Measuring for %ss" % args.duration, file=sys.stderr)
+        await asyncio.sleep(args.duration)
+
+        fleet.measuring = False
+        elapsed = monotonic() - start
+        server_cpu = process_cpu_seconds(server.pid) - server_cpu
+        fleet_cpu = sum(os.times()[:2]) - fleet_cpu
+        after = await scrape_results(session, base_url + "/metrics")
+
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "workers": args.workers,
+        "checks_per_worker": args.checks,
+        "interval": args.interval,
+        "latency_distribution": args.latency,
+        "seconds": round(elapsed, 1),
+        "dispatches_per_second": round(
+            (after["dsportal_dispatched_total"] - before["dsportal_dispatched_total"])
+            / elapsed,
+            1,
+        ),
+        "results_sent_per_second": round(fleet.results / elapsed, 1),
+        "results_accepted_per_second": round(
+            (after["dsportal_results_total"] - before["dsportal_results_total"])
+            / elapsed,
+            1,
+        ),
+        "results_refused": fleet.refused,
+        "dispatch_to_result_ms": summarise_histogram(before, after),
+        "worker_dispatch_to_send_ms": summarise(fleet.latencies),
+        "dispatch_lateness_ms": summarise(fleet.lateness),
+        "server_cpu_percent": round(100 * server_cpu / elapsed, 1),
+        "server_rss_bytes": process_rss_bytes(server.pid),
+        "fleet_cpu_percent": round(100 * fleet_cpu / elapsed, 1),
+    }
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=SCRIPT_DIR,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulated worker fleet against a local dsportal server"
+    )
+    parser.add_argument("--workers", type=int, default=100)
+    parser.add_argument("--checks", type=int, default=100, help="per worker")
+    parser.add_argument("--interval", type=int, default=10, help="seconds")
+    parser.add_argument("--latency", default="lognormal:50:1")
+    parser.add_argument(
+        "--failures", type=float, default=0.01, help="share of unhealthy results"
+    )
+    parser.add_argument("--duration", type=int, default=60, help="seconds")
+    parser.add_argument("output", nargs="?")
+    args = parser.parse_args()
+
+    # fail before starting the server
+    latency_distribution(args.latency)
+
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        tokens = write_config(directory, port, args.workers, args.checks, args.interval)
+
+        log_file = path.join(directory, "server.log")
+        with open(log_file, "w") as log:
+            server = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "from dsportal.server import main; main()",
+                    path.join(directory, "config.yml"),
+                ],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+        try:
+            result = asyncio.get_event_loop().run_until_complete(
+                run(args, server, log_file, tokens, "http://127.0.0.1:%s" % port)
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "result": result,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
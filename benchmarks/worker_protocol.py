@@ -0,0 +1,114 @@
+"""
+Compares the JSON worker protocol (one text frame per result) with the
+batched binary protocol of dsportal.protocol over a localhost websocket.
+Reports results/s, frames/s and bytes per result.
+
+Usage: python worker_protocol.py [number of results]
+"""
+import sys
+import json
+import asyncio
+from time import monotonic
+import aiohttp
+from aiohttp import web
+from dsportal import protocol
+
+PORT = 8791
+
+# typical results, as produced by RamUsage, HttpStatus and Uptime
+RESULTS = [
+    {
+        "healthy": True,
+        "value": "3.2 GB",
+        "bytes": 3200000000,
+        "bar_min": "0 GB",
+        "bar_max": "8.3 GB",
+        "bar_percent": 38,
+        "reason": "RAM usage nominal",
+    },
+    {"healthy": True, "value": 200, "reason": ""},
+    {"healthy": True, "value": "12 days", "reason": ""},
+]
+
+
+async def receiver(request):
+    stats = request.app["stats"]
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    async for msg in ws:
+        stats["frames"] += 1
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            stats["bytes"] += len(msg.data.encode())
+            id, result = json.loads(msg.data)
+            stats["results"] += 1
+        elif msg.type == aiohttp.WSMsgType.BINARY:
+            stats["bytes"] += len(msg.data)
+            kind, results = protocol.decode(msg.data)
+            stats["results"] += len(results)
+
+        if stats["results"] >= stats["expected"]:
+            stats["done"].set()
+
+    return ws
+
+
+async def run(ws, app, num, binary):
+    stats = app["stats"]
+    stats.update(
+        {
+            "frames": 0,
+            "bytes": 0,
+            "results": 0,
+            "expected": num,
+            "done": asyncio.Event(),
+        }
+    )
+
+    start = monotonic()
+
+    if binary:
+
+        async def send(results):
+            await ws.send_bytes(protocol.encode_results(results))
+
+        batcher = protocol.Batcher(send)
+        for x in range(num):
+            await batcher.add_wait((x, RESULTS[x % len(RESULTS)]))
+    else:
+        for x in range(num):
+            # uuid4 id as sent by the JSON protocol
+            await ws.send_json(
+                ("3b2c6a1e-4f0d-4a5e-9d7c-1e2f3a4b5c6d", RESULTS[x % len(RESULTS)])
+            )
+
+    await stats["done"].wait()
+    elapsed = monotonic() - start
+
+    return {
+        "results_per_second": int(num / elapsed),
+        "frames_per_second": int(stats["frames"] / elapsed),
+        "frames": stats["frames"],
+        "bytes_per_result": round(stats["bytes"] / num, 1),
+    }
+
+
+async def main(num):
+    app = web.Application()
+    app.router.add_get("/", receiver)
+    app["stats"] = dict()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    async with aiohttp.ClientSession() as session:
+        for name, binary in (("json", False), ("binary", True)):
+            async with session.ws_connect("http://127.0.0.1:%s/" % PORT) as ws:
+                print(name, await run(ws, app, num, binary))
+
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    asyncio.get_event_loop().run_until_complete(main(num))
@@ -1,6 +1,6 @@
 from dsportal.base import Alerter
-import boto3
 from dsportal.util import slug
+from dsportal.util import get_boto3_client
 import logging
 import requests
 
@@ -26,31 +26,36 @@ class AwsSnsSmsAlerter(Alerter):
 
         self.phone_numbers = phone_numbers
 
-        self.sns = boto3.client(
-            service_name="sns",
+        self.sns = get_boto3_client(
+            "sns",
             region_name=region_name,
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
         )
 
+    def recipients(self):
+        return self.phone_numbers
+
+    def send_alert(self, text, phone_number):
+        self.sns.publish(
+            PhoneNumber=phone_number,
+            Message=text,
+            MessageAttributes={
+                "AWS.SNS.SMS.SenderID": {
+                    "DataType": "String",
+                    "StringValue": slug(self.name).replace("_", "")[:11],
+                },
+                "AWS.SNS.SMS.SMSType": {
+                    "DataType": "String",
+                    "StringValue": "Transactional",
+                },
+            },
+        )
+
     def broadcast_alert(self, text):
         for pn in self.phone_numbers:
             try:
-                self.sns.publish(
-                    PhoneNumber=pn,
-                    Message=text,
-                    MessageAttributes={
-                        "AWS.SNS.SMS.SenderID": {
-                            "DataType": "String",
-                            "StringValue": slug(self.name).replace("_", "")[:11],
-                        },
-                        "AWS.SNS.SMS.SMSType": {
-                            "DataType": "String",
-                            "StringValue": "Transactional",
-                        },
-                    },
-                )
-
+                self.send_alert(text, pn)
             except:
                 log.exception("SNS client failure")
 
@@ -71,17 +76,21 @@ class SlackAlerter(Alerter):
         self.channel = channel
         self.icon_emoji = icon_emoji
 
+    def send_alert(self, text, recipient=None):
+        r = requests.post(
+            self.webhook_url,
+            json={
+                "username": self.username,
+                "channel": self.channel,
+                "text": text,
+                "icon_emoji": self.icon_emoji,
+            },
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+
     def broadcast_alert(self, text):
         try:
-            r = requests.post(
-                self.webhook_url,
-                json={
-                    "username": self.username,
-                    "channel": self.channel,
-                    "text": text,
-                    "icon_emoji": self.icon_emoji,
-                },
-            )
-            r.raise_for_status()
+            self.send_alert(text)
         except:
             log.exception("Slack webhook failure")
@@ -1,6 +1,8 @@
 from uuid import uuid4
+from hashlib import sha1
 from time import time
 from random import randint
+from random import random
 from functools import wraps
 from collections import OrderedDict, defaultdict
 from time import sleep
@@ -8,21 +10,50 @@ from time import monotonic
 from dsportal.util import extract_classes
 from dsportal.util import validate_result
 from dsportal.util import extract_classes
-from dsportal.util import TTLQueue
-from dsportal.util import ItemExpired
+from dsportal.util import DeadlineQueue
+from dsportal.util import NORMAL
+from dsportal.util import CRITICAL
+from dsportal.util import parse_priority
+from dsportal.util import Scheduler
 from dsportal.util import machine_seconds
+from dsportal.util import human_seconds
+from dsportal.pool import ProcessPool
+from dsportal.metrics import Metrics
+from dsportal.metrics import Histogram
+from dsportal.metrics import CHECK_BUCKETS
 import queue
 from threading import Thread
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import aiohttp
+import json
+import gzip
+from os import replace
+from os import getenv
+from os import path
+import cProfile
+import pstats
 from dsportal import __version__ as version
 
 import logging
 
 log = logging.getLogger(__name__)
 
+# healthchecks encoded per json.dumps call by Index.write_snapshot()
+SNAPSHOT_CHUNK = 1000
+
 
 class Entity(object):
-    def __init__(self, name, tab, worker=None, healthchecks=[], description=""):
+    def __init__(
+        self,
+        name,
+        tab,
+        worker=None,
+        healthchecks=[],
+        description="",
+        priority="normal",
+    ):
         # Used for DOM ID as well
         self.id = str(uuid4())
 
@@ -49,21 +80,26 @@ class Entity(object):
         for h in healthchecks:
             cls = h.pop("cls")
             h["worker"] = h.get("worker", worker)
+            h["priority"] = h.get("priority", priority)
             healthcheck = HCLASSES[cls](entity=self, **h)  # TODO handle keyerror here
             self.healthchecks.append(healthcheck)
 
-    def evaluate_health(self):
-        self.healthy = True
+        # number of healthchecks by health, maintained by update_health()
+        self.num_by_health = {True: 0, None: len(self.healthchecks), False: 0}
 
-        for h in self.healthchecks:
-            if h.result["healthy"] is None:
-                self.healthy = None
-                break
+    def update_health(self, old, new):
+        "Account for a healthcheck changing health from old to new"
+        self.num_by_health[old] -= 1
+        self.num_by_health[new] += 1
+        self.evaluate_health()
 
-        for h in self.healthchecks:
-            if h.result["healthy"] is False:
-                self.healthy = False
-                break
+    def evaluate_health(self):
+        if self.num_by_health[False]:
+            self.healthy = False
+        elif self.num_by_health[None]:
+            self.healthy = None
+        else:
+            self.healthy = True
 
 
 class HealthCheck(object):
@@ -74,8 +110,29 @@ class HealthCheck(object):
         60
     )  # default in seconds, can be overridden in configuration using notation accepted by machine_seconds()
 
-    def __init__(self, entity, interval=None, worker=None, label=None, **kwargs):
+    # bounds of the adaptive interval: re-check at min_interval when failing or
+    # unknown, back off towards max_interval while healthy. Default to interval
+    # (not adaptive). Can be overridden in configuration.
+    min_interval = None
+    max_interval = None
+
+    # checks that keep state between runs are passed check_key, their key, by
+    # Index to find it by
+    stateful = False
+
+    def __init__(
+        self,
+        entity,
+        interval=None,
+        worker=None,
+        label=None,
+        min_interval=None,
+        max_interval=None,
+        priority="normal",
+        **kwargs
+    ):
         self.id = str(uuid4())
+        self._key = None
 
         if entity and not isinstance(entity, Entity):
             raise ValueError('Entity instance expected for "entity"')
@@ -85,12 +142,27 @@ class HealthCheck(object):
         self.worker = worker
         self.cls = self.__class__.__name__
 
+        # Priority of dsportal.proto. Critical checks are run first by workers
+        self.priority = parse_priority(priority)
+
         # kwargs to pass to check
         self.check_kwargs = kwargs
 
-        self.interval = machine_seconds(interval) if interval else self.interval
+        # configured interval. self.interval is the current (adaptive) interval.
+        self.base_interval = machine_seconds(interval) if interval else self.interval
+        self.interval = self.base_interval
 
-        self.timeout = self.interval * 2
+        min_interval = min_interval or self.min_interval
+        max_interval = max_interval or self.max_interval
+        self.min_interval = (
+            machine_seconds(min_interval) if min_interval else self.base_interval
+        )
+        self.max_interval = (
+            machine_seconds(max_interval) if max_interval else self.base_interval
+        )
+
+        if not self.min_interval <= self.base_interval <= self.max_interval:
+            raise ValueError("Must have min_interval <= interval <= max_interval")
 
         self.result = {"healthy": None, "reason": "Waiting for check"}
 
@@ -102,6 +174,9 @@ class HealthCheck(object):
         self.last_start = None
         self.last_finish = None
 
+        # Index.generation of the last change shown to clients
+        self.generation = 0
+
         self.server_version = version
 
         # set an alias for 2 or more of the same healthcheck on one entity,
@@ -109,11 +184,59 @@ class HealthCheck(object):
         if label:
             self.label = label
 
+    @property
+    def timeout(self):
+        return self.interval * 2
+
+    @property
+    def adaptive(self):
+        return self.min_interval != self.max_interval
+
+    def adapt_interval(self, old_healthy, healthy):
+        """Double the interval (up to max_interval) for each consecutive
+        healthy result, start again from the configured interval on recovery
+        and use min_interval while failing or unknown."""
+        if not healthy:
+            self.interval = self.min_interval
+        elif old_healthy:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+
+    @property
+    def key(self):
+        """Identity of this healthcheck that is stable across restarts, unlike
+        id. Derived from the configuration; Index numbers any duplicates."""
+        if not self._key:
+            config = [
+                self.entity.name if self.entity else None,
+                self.cls,
+                self.label,
+                self.check_kwargs,
+            ]
+
+            # local checks keep the keys they had before workers were included
+            if self.worker not in (None, "local"):
+                config.append(self.worker)
+
+            config = json.dumps(config, sort_keys=True, default=str)
+            self._key = sha1(config.encode()).hexdigest()[:16]
+
+        return self._key
+
     def update(self, result):
+        "Returns True if the result differs from the last one"
         validate_result(result)
+        changed = result != self.result
+        old_healthy = self.result["healthy"]
         self.result = result
         self.last_finish = monotonic()
 
+        # results made up by a worker or the server, not the check, such as
+        # for an overloaded worker, must not bring checks forward
+        if not result.get("synthetic"):
+            self.adapt_interval(old_healthy, result["healthy"])
+
         if result["healthy"]:
             log.debug("Check passed: %s %s", self.cls, self.check_kwargs)
         else:
@@ -126,14 +249,24 @@ class HealthCheck(object):
             log.debug("Result: %s", result)
 
         # TODO Entity.healty could be a @property -- however, may complicate client patching
-        self.entity.evaluate_health()
+        self.entity.update_health(old_healthy, result["healthy"])
+
+        return changed
 
     @staticmethod
     def check():
         """Run healthcheck. Must be stateless. Must not be run directly. Use
-        run(). Exceptions will be caught and treated as failures"""
+        run(). Exceptions will be caught and treated as failures.
+
+        May be defined as `async def check(session, ...)` instead, in which
+        case it is run on the event loop of the worker rather than a thread,
+        and given a shared aiohttp.ClientSession as `session`."""
         raise NotImplemented()
 
+    @classmethod
+    def is_async(CLASS):
+        return asyncio.iscoroutinefunction(CLASS.check)
+
     @classmethod
     def run_check(CLASS, **kwargs):
         """Run check in exception wrapper"""
@@ -142,6 +275,24 @@ class HealthCheck(object):
             result = CLASS.check(**kwargs)
         except Exception as e:
             result = {"healthy": None, "reason": str(e)}
+
+        return CLASS._annotate_result(result)
+
+    @classmethod
+    async def run_check_async(CLASS, session, **kwargs):
+        """Run coroutine check in exception wrapper"""
+        log.debug("Processing check: %s %s", CLASS.__name__, kwargs)
+        try:
+            result = await CLASS.check(session=session, **kwargs)
+        except asyncio.TimeoutError:
+            result = {"healthy": None, "reason": "Check timed out"}
+        except Exception as e:
+            result = {"healthy": None, "reason": str(e)}
+
+        return CLASS._annotate_result(result)
+
+    @classmethod
+    def _annotate_result(CLASS, result):
         validate_result(result)
 
         if not result["healthy"]:
@@ -158,16 +309,6 @@ class HealthCheck(object):
 
         return result
 
-    async def loop(self, callback, initial_delay=0):
-        """Callback (self) at interval. Add to event loop as guarded task."""
-        await asyncio.sleep(initial_delay)
-        await asyncio.sleep(self.delay)
-
-        while True:
-            self.last_start = monotonic()
-            callback(self)
-            await asyncio.sleep(self.interval)
-
     def __str__(self):
         return "{cls} {check_kwargs}".format(**self.__dict__)
 
@@ -175,7 +316,7 @@ class HealthCheck(object):
 class Index(object):
     "Keeps track of HealthcheckState and Entity objects organised by tabs, worker, etc"
 
-    def __init__(self, name):
+    def __init__(self, name, worker_config=None):
         self.name = name
         # indices
         self.entities = list()
@@ -185,6 +326,12 @@ class Index(object):
         self.healthchecks = list()
         self.healthchecks_by_worker = defaultdict(list)
         self.healthcheck_by_id = dict()
+        self.healthcheck_by_key = dict()
+
+        # healthchecks and entities (with healthchecks) by id, grouped by
+        # health: True, None (unknown) or False. Maintained on each result.
+        self.healthchecks_by_health = {True: dict(), None: dict(), False: dict()}
+        self.entities_by_health = {True: dict(), None: dict(), False: dict()}
 
         # TODO remove unused indicies
 
@@ -192,18 +339,44 @@ class Index(object):
 
         self.entity_classes = extract_classes("dsportal.entities", Entity)
 
+        # worker name -> dsportal.protocol.WorkerLink
         self.worker_websockets = dict()
-        self.client_websockets = list()
-
-        # list of tasks registered on the event loop to schedule healthchecks
-        self.tasks = list()
-
-        self.local_worker = Worker()
+        self.client_websockets = set()
+
+        # changes not yet pushed to client websockets, coalesced by
+        # push_deltas() into one frame every client_update_interval seconds
+        self.client_update_interval = 0.5
+        self.delta_healthchecks = dict()
+        self.delta_entities = dict()
+        # last send to each client websocket, to detect slow clients
+        self.client_sends = dict()
+
+        # incremented whenever a result changes, to invalidate rendered pages.
+        # instance_id distinguishes generations across restarts.
+        self.instance_id = uuid4().hex[:8]
+        self.generation = 0
+        # generation of the last change shown on each tab, and of the last
+        # change of health, which moves the counts shown on every tab
+        self.tab_generations = defaultdict(int)
+        self.health_generation = 0
+
+        # single heap of due times for all healthchecks
+        self.scheduler = Scheduler()
+
+        self.local_worker = Worker(**(worker_config or dict()))
         self.local_worker.start()
 
         self.alerter_classes = extract_classes("dsportal.alerters", Alerter)
         self.alerters = list()
 
+        # held while a snapshot file is written
+        self.snapshot_lock = Lock()
+
+        # optional dsportal.history.History
+        self.history = None
+
+        self.metrics = Metrics()
+
     def instantiate_entity(self, cls, **config):
         try:
             entity = self.entity_classes[cls](**config)
@@ -219,39 +392,96 @@ class Index(object):
         else:
             self.entities_by_tab[entity.tab] = [entity]
 
+        if entity.healthchecks:
+            self.entities_by_health[entity.healthy][entity.id] = entity
+
         for hcs in entity.healthchecks:
+            # small integer id used by the worker protocol
+            hcs.number = len(self.healthchecks)
             self.healthchecks.append(hcs)
             self.healthchecks_by_worker[hcs.worker].append(hcs)
             self.healthcheck_by_id[hcs.id] = hcs
 
+            # identical checks of one entity on one worker; number them in
+            # order of definition
+            key = hcs.key
+            n = 1
+            while hcs.key in self.healthcheck_by_key:
+                n += 1
+                hcs._key = "%s-%s" % (key, n)
+            self.healthcheck_by_key[hcs.key] = hcs
+
+            if hcs.stateful:
+                hcs.check_kwargs["check_key"] = hcs.key
+
+            self.healthchecks_by_health[hcs.result["healthy"]][hcs.id] = hcs
+            self.metrics.update_healthcheck(hcs)
+
     def register_tasks(self, loop):
         for h in self.healthchecks:
-            # wait 12 seconds for all workers to reconnect
-            task = loop.create_task(
-                h.loop(self._dispatch_check, initial_delay=12 if h.worker else 0)
-            )
+            self.schedule(h)
 
-            log.debug("Registered %s for %s", h, h.worker or "local worker")
-            self.tasks.append(task)
+        loop.create_task(self.scheduler.run(self._dispatch_check))
 
         loop.create_task(
-            self.local_worker.read_results(lambda r: self.dispatch_result(r[0], r[1]))
+            self.local_worker.read_results(lambda r: self.receive_result(r[0], r[1]))
         )
 
         loop.create_task(self.check_timeouts())
 
+        loop.create_task(self.push_deltas())
+
+        if self.history:
+            loop.create_task(self.write_history())
+
+        for a in self.alerters:
+            loop.create_task(a.deliver())
+
+    def schedule(self, h):
+        "Schedule healthcheck. Can be called at runtime."
+        # wait 12 seconds for all workers to reconnect
+        initial_delay = 12 if h.worker else 0
+        delay = initial_delay + h.delay
+
+        # resume previous phase if restored from a snapshot and not overdue,
+        # otherwise spread out as usual to avoid a stampede
+        if h.last_start:
+            remaining = h.last_start + h.interval - monotonic()
+            if remaining > initial_delay:
+                delay = remaining
+
+        self.scheduler.add(h, delay=delay)
+        log.debug("Registered %s for %s", h, h.worker or "local worker")
+
+    def unschedule(self, h):
+        self.scheduler.remove(h)
+
     def _dispatch_check(self, h):
+        h.last_start = monotonic()
+        self.metrics.dispatched[h.worker or "local"] += 1
+
         if h.worker == "local" or h.worker == None:
-            self.local_worker.enqueue(h.cls, h.id, **h.check_kwargs)
+            self.local_worker.enqueue(h.cls, h.id, h.priority, **h.check_kwargs)
         else:
             try:
-                self.worker_websockets[h.worker].send_json(
-                    (h.cls, h.id, h.check_kwargs)
-                )
+                if not self.worker_websockets[h.worker].dispatch(h):
+                    log.warn("Link to worker %s congested, check dropped", h.worker)
+                    self.metrics.undelivered["congested"] += 1
+                    result = {
+                        "healthy": None,
+                        "reason": "Link to worker %s was congested" % h.worker,
+                        "synthetic": True,
+                    }
+                    self.dispatch_result(h.id, result)
             except KeyError:
                 log.warn("Worker %s not connected for healthcheck", h.worker)
+                self.metrics.undelivered["offline"] += 1
                 # Invalidate result
-                result = {"healthy": None, "reason": "Worker %s was offline" % h.worker}
+                result = {
+                    "healthy": None,
+                    "reason": "Worker %s was offline" % h.worker,
+                    "synthetic": True,
+                }
                 validate_result(result)
                 self.dispatch_result(h.id, result)
                 # NOTE Context was set to worker name, however connection
@@ -263,47 +493,224 @@ class Index(object):
                 # connection issues don't matter as much.
                 # self._alert('workers','Worker(s) are having connection issues')
 
+    def receive_result(self, id, result):
+        "Result of a check run by a worker, timed from its dispatch"
+        h = self.healthcheck_by_id[id]
+
+        if h.last_start:
+            self.metrics.result_seconds[h.worker or "local"].observe(
+                monotonic() - h.last_start
+            )
+
+        self.dispatch_result(id, result)
+
     def dispatch_result(self, id, result):
         h = self.healthcheck_by_id[id]
-        h.update(result)
 
-        # TODO delta updates!
-        for ws in self.client_websockets:
-            ws.send_json((id, healthcheck.result))
+        self.metrics.results[h.worker or "local"] += 1
+
+        interval = h.interval
+
+        self._apply_result(h, result)
+
+        if h.interval != interval:
+            # shown on healthchecks tab
+            self._changed(h)
+
+            if h.interval < interval and h.last_start:
+                # bring forward the next check, already scheduled at the old interval
+                self.scheduler.reschedule(
+                    h, delay=max(0, h.last_start + h.interval - monotonic())
+                )
+
+        if self.history:
+            self.history.record(h.key, h.result)
 
         if result["healthy"] == False:
             # stop iOS previews: http://support.fastsms.co.uk/knowledgebase/ios-10-update-impacts-sms-messages/
             # leave a space at the end!
             self._alert(
-                h.id,
+                h.key,
                 "{h.label} unhealthy on {h.entity.name}, reason: {h.result[reason]} ".format(
                     h=h
                 ),
+                h.entity.name,
             )
 
+    def _apply_result(self, h, result):
+        "Update healthcheck and all derived state"
+        e = h.entity
+
+        healthy = h.result["healthy"]
+        entity_healthy = e.healthy
+
+        if h.update(result):
+            self._changed(h)
+            self.metrics.update_healthcheck(h)
+
+        if e.healthy != entity_healthy:
+            self.delta_entities[e.id] = e
+
+        if healthy != h.result["healthy"]:
+            self.health_generation = self.generation
+
+        self._regroup(self.healthchecks_by_health, h, healthy, h.result["healthy"])
+        self._regroup(self.entities_by_health, e, entity_healthy, e.healthy)
+
+    def _changed(self, h):
+        "Invalidate pages showing h and queue h for client websockets"
+        self.generation += 1
+        h.generation = self.generation
+        self.tab_generations[h.entity.tab] = self.generation
+        self.tab_generations["healthchecks"] = self.generation
+        self.delta_healthchecks[h.id] = h
+
+    def tab_generation(self, tab):
+        "Generation of the last change to the rendered page of tab"
+        return max(self.tab_generations[tab], self.health_generation)
+
+    @staticmethod
+    def _regroup(groups, item, old, new):
+        if old != new:
+            del groups[old][item.id]
+            groups[new][item.id] = item
+
+    # N.B. groups are ordered by time of last change of health, not definition
+
     @property
     def healthy_healthchecks(self):
-        return [h for h in self.healthchecks if h.result["healthy"] == True]
+        return list(self.healthchecks_by_health[True].values())
 
     @property
     def unknown_healthchecks(self):
-        return [h for h in self.healthchecks if h.result["healthy"] == None]
+        return list(self.healthchecks_by_health[None].values())
 
     @property
     def unhealthy_healthchecks(self):
-        return [h for h in self.healthchecks if h.result["healthy"] == False]
+        return list(self.healthchecks_by_health[False].values())
 
     @property
     def healthy_entities(self):
-        return [e for e in self.entities if e.healthy == True]
+        return list(self.entities_by_health[True].values())
 
     @property
     def unknown_entities(self):
-        return [e for e in self.entities if e.healthy == None and e.healthchecks]
+        return list(self.entities_by_health[None].values())
 
     @property
     def unhealthy_entities(self):
-        return [e for e in self.entities if e.healthy == False]
+        return list(self.entities_by_health[False].values())
+
+    def _tab_contents(self, tab):
+        "Healthchecks and entities shown on tab"
+        if tab == "healthchecks":
+            return self.healthchecks, []
+
+        entities = self.entities_by_tab.get(tab, [])
+        return [h for e in entities for h in e.healthchecks], entities
+
+    @staticmethod
+    def client_healthcheck(h):
+        "What the templates render of h"
+        return {
+            "result": h.result,
+            "interval": human_seconds(h.interval) + ("*" if h.adaptive else ""),
+        }
+
+    def client_frame(self, healthchecks, entities):
+        return {
+            "generation": self.generation,
+            "healthchecks": {h.id: self.client_healthcheck(h) for h in healthchecks},
+            "entities": {e.id: e.healthy for e in entities},
+            "num_healthy": len(self.healthchecks_by_health[True]),
+            "num_unknown": len(self.healthchecks_by_health[None]),
+            "num_unhealthy": len(self.healthchecks_by_health[False]),
+        }
+
+    def client_state(self, tab):
+        """Frame of everything shown on tab, sent to a client websocket on
+        connect so the page can be patched however old it is"""
+        frame = self.client_frame(*self._tab_contents(tab))
+        # healthcheck ids change on restart, so pages must then be reloaded
+        frame["instance"] = self.instance_id
+        return frame
+
+    def add_client(self, ws, tab=None, generation=None):
+        """Push deltas to ws. Changes to tab after generation, when its state
+        was sent, are included in the next frame."""
+        if generation is not None:
+            for h in self._tab_contents(tab)[0]:
+                if h.generation > generation:
+                    self.delta_healthchecks[h.id] = h
+                    self.delta_entities[h.entity.id] = h.entity
+
+        self.client_websockets.add(ws)
+
+    def remove_client(self, ws):
+        self.client_websockets.discard(ws)
+        send = self.client_sends.pop(ws, None)
+        if send:
+            send.cancel()
+
+    async def push_deltas(self):
+        """Broadcast changed results and entity health to client websockets.
+        Each frame is serialised once. Clients that have not received the
+        previous frame by the time the next is ready are evicted rather than
+        buffered; they reconnect and are sent the current state."""
+        while True:
+            await asyncio.sleep(self.client_update_interval)
+
+            if not self.delta_healthchecks and not self.delta_entities:
+                continue
+
+            if not self.client_websockets:
+                # clients are sent the current state when they connect
+                self.delta_healthchecks = dict()
+                self.delta_entities = dict()
+                continue
+
+            frame = json.dumps(
+                self.client_frame(
+                    self.delta_healthchecks.values(), self.delta_entities.values()
+                )
+            )
+
+            self.delta_healthchecks = dict()
+            self.delta_entities = dict()
+
+            for ws in list(self.client_websockets):
+                send = self.client_sends.get(ws)
+
+                if send and not send.done():
+                    log.warn("Evicting slow client websocket")
+                    self.remove_client(ws)
+                    asyncio.ensure_future(ws.close())
+                    continue
+
+                if ws.closed:
+                    # client_websocket removes it once the close is handled
+                    continue
+
+                send = asyncio.ensure_future(ws.send_str(frame))
+                send.add_done_callback(self._client_sent)
+                self.client_sends[ws] = send
+
+    @staticmethod
+    def _client_sent(send):
+        "Read the outcome of a send, so a client gone away is not an error"
+        if not send.cancelled() and send.exception():
+            log.debug("Client websocket send failed: %r", send.exception())
+
+    async def write_history(self, interval=1):
+        "Write history samples recorded on the loop in batches, in a thread"
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await asyncio.sleep(interval)
+
+            samples = self.history.take()
+            if samples:
+                await loop.run_in_executor(None, self.history.write, samples)
 
     async def check_timeouts(self):
         while True:
@@ -312,14 +719,119 @@ class Index(object):
             for h in self.healthchecks:
                 if h.last_finish and h.last_finish < t - h.timeout:
                     log.warn("Healthcheck %s timeout", h)
+                    self.metrics.timeouts += 1
                     # Invalidate result
-                    result = {"healthy": None}
+                    result = {"healthy": None, "synthetic": True}
                     validate_result(result)
                     self.dispatch_result(h.id, result)
 
-    def _alert(self, context, text):
+    def snapshot(self):
+        """Results, timings and alerter throttle state, taken on the loop and
+        serialised by write_snapshot() in a thread. Results are replaced,
+        never modified, once applied."""
+        return (
+            # monotonic times do not survive restarts
+            time() - monotonic(),
+            [
+                (h.key, h.result, h.last_start, h.last_finish, h.interval)
+                for h in self.healthchecks
+                if h.last_finish
+            ],
+            [[a.__class__.__name__, a.snapshot()] for a in self.alerters],
+        )
+
+    def write_snapshot(self, filepath, snapshot):
+        """Write a snapshot() to a gzipped JSON file, atomically. Healthchecks
+        are identified by their stable key. They are encoded in chunks, as
+        json.dumps holds the GIL and would stall the event loop."""
+        offset, healthchecks, alerters = snapshot
+
+        parts = ['{"version":1,"healthchecks":{']
+        for i in range(0, len(healthchecks), SNAPSHOT_CHUNK):
+            if i:
+                parts.append(",")
+            chunk = {
+                key: [
+                    result,
+                    last_start + offset if last_start else None,
+                    last_finish + offset,
+                    interval,
+                ]
+                for key, result, last_start, last_finish, interval in healthchecks[
+                    i : i + SNAPSHOT_CHUNK
+                ]
+            }
+            parts.append(json.dumps(chunk, separators=(",", ":"))[1:-1])
+        parts.append('},"alerters":%s}' % json.dumps(alerters, separators=(",", ":")))
+
+        with self.snapshot_lock:
+            # written often, so favour speed over size
+            with gzip.open(filepath + ".tmp", "wb", compresslevel=1) as f:
+                f.write("".join(parts).encode())
+
+            replace(filepath + ".tmp", filepath)
+
+        log.debug("Snapshot saved to %s", filepath)
+
+    def save_snapshot(self, filepath):
+        self.write_snapshot(filepath, self.snapshot())
+
+    def load_snapshot(self, filepath):
+        """Restore state saved by save_snapshot(). Must be called after
+        entities and alerters are instantiated but before register_tasks() so
+        that healthchecks resume their previous phase."""
+        try:
+            with gzip.open(filepath, "rt") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+
+        if snapshot.get("version") != 1:
+            log.warn("Ignoring snapshot %s of unknown version", filepath)
+            return
+
+        offset = time() - monotonic()
+        restored = 0
+
+        for h in self.healthchecks:
+            try:
+                entry = snapshot["healthchecks"][h.key]
+            except KeyError:
+                continue
+
+            result, last_start, last_finish = entry[:3]
+            interval = entry[3] if len(entry) > 3 else h.interval
+
+            self._apply_result(h, result)
+            h.last_start = last_start - offset if last_start else None
+            h.last_finish = last_finish - offset
+
+            # configuration may have changed since
+            h.interval = min(max(interval, h.min_interval), h.max_interval)
+            restored += 1
+
+        for a, (cls, state) in zip(self.alerters, snapshot["alerters"]):
+            if a.__class__.__name__ == cls:
+                a.restore(state)
+
+        log.info("Restored %s healthcheck results from %s", restored, filepath)
+
+    async def save_snapshots(self, filepath, interval=60):
+        "Save a snapshot every interval seconds, serialised in a thread"
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(
+                    None, self.write_snapshot, filepath, self.snapshot()
+                )
+            except OSError:
+                log.exception("Could not save snapshot")
+
+    def _alert(self, context, text, entity=None):
         for a in self.alerters:
-            a.alert(context, text)
+            a.alert(context, text, entity)
 
     def instantiate_alerter(self, cls, **kwargs):
         try:
@@ -332,100 +844,568 @@ class Index(object):
 
 
 class Worker(object):
-    def __init__(self):
+    def __init__(
+        self,
+        concurrency=1000,
+        process_checks=None,
+        processes=2,
+        min_threads=4,
+        max_threads=64,
+        grow_wait=0.5,
+        idle_timeout=60,
+        profile=None,
+        profile_dir=None,
+    ):
+        """
+        Args:
+            concurrency (int): Max number of coroutine checks in flight
+            process_checks (dict): Check class name -> hard deadline in seconds,
+                for checks to run in a child process instead of a thread
+            processes (int): Number of child processes for process_checks
+            min_threads (int): Threads for blocking checks kept running
+            max_threads (int): Threads for blocking checks are added, up to
+                this many, while checks wait more than grow_wait seconds in
+                the queue or all threads are busy
+            grow_wait (float): Queue wait in seconds that adds a thread
+            idle_timeout (int): Seconds a thread above min_threads may be idle
+                before it exits
+            profile (float): Fraction of blocking checks to run under
+                cProfile. Defaults to DSPORTAL_PROFILE, or 0.
+            profile_dir (str): Where to write aggregated profiles and timings
+                every minute. Defaults to DSPORTAL_PROFILE_DIR, or the current
+                directory.
+        """
         # drop items if workers are too busy -- time not number of items
-        self.work_queue = TTLQueue(maxsize=1000, ttl=5)
+        # served by priority then deadline; expired or evicted checks are
+        # reported by _dropped
+        self.work_queue = DeadlineQueue(maxsize=1000, ttl=5, on_expired=self._dropped)
+        # check class -> number of checks dropped
+        self.drops = defaultdict(int)
         # connection problems should not result in old results coming backk
-        self.result_queue = TTLQueue(maxsize=1000, ttl=5)
+        self.result_queue = asyncio.Queue(maxsize=1000)
+        self.result_ttl = 5
 
-        self.hclasses = extract_classes("dsportal.healthchecks", HealthCheck)
+        # event loop that reads results and runs coroutine checks, set by start()
+        self.loop = None
+
+        # coroutine checks in flight, sharing one pooled HTTP session
+        self.concurrency = concurrency
+        self.num_async = 0
+        self.session = None
 
-    def start(self, count=4):
-        for x in range(count):
-            t = Thread()
-            t = Thread(target=self._worker)
-            t.daemon = True
-            t.start()
+        self.process_checks = {
+            cls: machine_seconds(deadline)
+            for cls, deadline in (process_checks or dict()).items()
+        }
+        self.process_pool = ProcessPool(processes) if self.process_checks else None
 
-        return t
+        self.hclasses = extract_classes("dsportal.healthchecks", HealthCheck)
+
+        # elastic thread pool for blocking checks
+        self.min_threads = min_threads
+        self.max_threads = max(min_threads, max_threads)
+        self.grow_wait = grow_wait
+        self.idle_timeout = idle_timeout
+        self.threads_lock = Lock()
+        self.num_threads = 0
+        self.num_busy = 0
+        # exponentially weighted moving average of seconds checks wait in queue
+        self.queue_wait = 0
+
+        # (queue wait, execution) histograms by check class, and by check
+        # class and id
+        self.timings = dict()
+        self.timings_by_check = dict()
+        self.timings_lock = Lock()
+
+        if profile is None:
+            profile = float(getenv("DSPORTAL_PROFILE", 0))
+
+        self.profile = profile
+        self.profile_dir = profile_dir or getenv("DSPORTAL_PROFILE_DIR", ".")
+        # check class -> aggregated pstats.Stats
+        self.profiles = dict()
+        # only one check is profiled at a time
+        self.profile_lock = Lock()
+
+    def start(self, count=None, loop=None):
+        "count overrides min_threads"
+        self.loop = loop or asyncio.get_event_loop()
+
+        if count:
+            self.min_threads = count
+            self.max_threads = max(count, self.max_threads)
+
+        if self.process_pool:
+            self.process_pool.start()
+
+        for x in range(self.min_threads):
+            self._add_thread()
+
+        if self.profile:
+            log.info("Profiling %s%% of checks", self.profile * 100)
+            self.loop.create_task(self.dump_profiles())
+
+    def _add_thread(self):
+        "Must be called with threads_lock held, or before threads are running"
+        self.num_threads += 1
+        t = Thread(target=self._worker)
+        t.daemon = True
+        t.start()
+
+    def stats(self):
+        return {
+            "threads": self.num_threads,
+            "busy_threads": self.num_busy,
+            "min_threads": self.min_threads,
+            "max_threads": self.max_threads,
+            "utilisation": self.num_busy / max(1, self.num_threads),
+            "queue_wait": self.queue_wait,
+            "queued": self.work_queue.qsize(),
+            "async_checks": self.num_async,
+            "drops": dict(self.drops),
+        }
+
+    def enqueue(self, cls, id, priority=NORMAL, **kwargs):
+        "Must be called from the event loop"
+        hclass = self.hclasses.get(cls)
+
+        if hclass and hclass.is_async() and cls not in self.process_checks:
+            self._enqueue_async(hclass, id, priority, kwargs)
+        else:
+            try:
+                self.work_queue.put_nowait((cls, id, kwargs), priority)
+            except queue.Full:
+                self._drop(cls, id)
+                return
 
-    def enqueue(self, cls, id, **kwargs):
-        self.work_queue.put_nowait((cls, id, kwargs))
         log.debug("Check enqueued: %s", cls)
 
+    def _enqueue_async(self, hclass, id, priority, kwargs):
+        # critical checks may exceed concurrency
+        if self.num_async >= self.concurrency and priority != CRITICAL:
+            self._drop(hclass.__name__, id)
+            return
+
+        self.num_async += 1
+        self.loop.create_task(self._run_async(hclass, id, kwargs, monotonic()))
+
+    async def _run_async(self, hclass, id, kwargs, enqueued):
+        start = monotonic()
+
+        try:
+            if self.session is None:
+                # trust_env: honour HTTP(S)_PROXY and NO_PROXY, as requests did
+                self.session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.concurrency),
+                    trust_env=True,
+                )
+
+            result = await hclass.run_check_async(self.session, **kwargs)
+        finally:
+            self.num_async -= 1
+
+        self._record(hclass.__name__, id, start - enqueued, monotonic() - start)
+
+        self._put_result_nowait(id, result)
+
+    def _drop(self, cls, id):
+        "Must be called from the event loop"
+        self.drops[cls] += 1
+        self._put_result_nowait(
+            id,
+            {
+                "healthy": None,
+                "reason": "Worker was too busy to run this health check in time",
+                "synthetic": True,
+            },
+        )
+        log.warn("Check dropped: %s", cls)
+
+    def _dropped(self, items):
+        "Expired or evicted from work queue, called from any thread"
+        self.loop.call_soon_threadsafe(
+            lambda: [self._drop(cls, id) for cls, id, kwargs in items]
+        )
+
+    def _put_result(self, id, result):
+        "Hand a result from a worker thread to the event loop"
+        self.loop.call_soon_threadsafe(self._put_result_nowait, id, result)
+
+    def _put_result_nowait(self, id, result):
+        "Must be called from the event loop"
+        try:
+            self.result_queue.put_nowait(((id, result), monotonic() + self.result_ttl))
+        except asyncio.QueueFull:
+            log.warn("Result dropped: result queue full")
+
     def _worker(self):
         while True:
             try:
-                cls, id, kwargs = self.work_queue.get_wait()
-            except ItemExpired as e:
-                cls, id, kwargs = e.item
-                self.result_queue.put_nowait(
-                    (
-                        id,
-                        {
-                            "healthy": None,
-                            "reason": "Worker was too busy to run this health check in time",
-                        },
-                    )
+                (cls, id, kwargs), waited = self.work_queue.get_wait(
+                    timeout=self.idle_timeout
                 )
-                log.warn("Check dropped: %s", cls)
+            except queue.Empty:
+                with self.threads_lock:
+                    if self.num_threads > self.min_threads:
+                        self.num_threads -= 1
+                        log.info("Idle, %s worker threads", self.num_threads)
+                        return
                 continue
 
+            with self.threads_lock:
+                self.num_busy += 1
+                self.queue_wait += 0.1 * (waited - self.queue_wait)
+
+                if self.num_threads < self.max_threads and (
+                    waited > self.grow_wait
+                    or (self.num_busy == self.num_threads and self.work_queue.qsize())
+                ):
+                    self._add_thread()
+                    log.info(
+                        "Checks waited %.2fs, %s worker threads",
+                        waited,
+                        self.num_threads,
+                    )
+
             try:
-                fn = self.hclasses[cls].run_check
-            except KeyError:
-                self.result_queue.put_nowait(
-                    (id, {"healthy": None, "reason": "Healthcheck not known by worker"})
-                )
-                log.warn("Check unknown: %s", cls)
-                self.work_queue.task_done()
-                continue
+                self._run(cls, id, kwargs, waited)
+            finally:
+                with self.threads_lock:
+                    self.num_busy -= 1
 
+    def _run(self, cls, id, kwargs, waited):
+        try:
+            fn = self.hclasses[cls].run_check
+        except KeyError:
+            self._put_result(
+                id, {"healthy": None, "reason": "Healthcheck not known by worker"}
+            )
+            log.warn("Check unknown: %s", cls)
+            return
+
+        start = monotonic()
+
+        if cls in self.process_checks:
+            result = self.process_pool.run_check(cls, kwargs, self.process_checks[cls])
+        elif (
+            self.profile
+            and random() < self.profile
+            and self.profile_lock.acquire(blocking=False)
+        ):
+            try:
+                result = self._profiled(cls, fn, kwargs)
+            finally:
+                self.profile_lock.release()
+        else:
             result = fn(**kwargs)
-            self.work_queue.task_done()
-            self.result_queue.put_nowait((id, result))
+
+        self._record(cls, id, waited, monotonic() - start)
+        self._put_result(id, result)
+
+    def _record(self, cls, id, waited, elapsed):
+        with self.timings_lock:
+            for key, timings in (
+                (cls, self.timings),
+                ((cls, id), self.timings_by_check),
+            ):
+                if key not in timings:
+                    timings[key] = Histogram(CHECK_BUCKETS), Histogram(CHECK_BUCKETS)
+
+                timings[key][0].observe(waited)
+                timings[key][1].observe(elapsed)
+
+    def _profiled(self, cls, fn, kwargs):
+        "Must be called with profile_lock held"
+        profiler = cProfile.Profile()
+        result = profiler.runcall(fn, **kwargs)
+
+        if cls in self.profiles:
+            self.profiles[cls].add(profiler)
+        else:
+            self.profiles[cls] = pstats.Stats(profiler)
+
+        return result
+
+    async def dump_profiles(self, interval=60):
+        "Write aggregated profiles and timings to profile_dir every interval"
+        while True:
+            await asyncio.sleep(interval)
+            await self.loop.run_in_executor(None, self._dump_profiles)
+
+    def _dump_profiles(self):
+        with self.profile_lock:
+            for cls, stats in self.profiles.items():
+                stats.dump_stats(path.join(self.profile_dir, "dsportal-%s.prof" % cls))
+
+        with open(path.join(self.profile_dir, "dsportal-timings.txt"), "w") as f:
+            f.write(self.timings_report())
+
+    def timings_report(self, top=50):
+        "Checks that used the most worker time, with 95th percentile timings"
+        with self.timings_lock:
+            rows = [
+                (str(key), wait, execution)
+                for timings in (self.timings, self.timings_by_check)
+                for key, (wait, execution) in timings.items()
+            ]
+
+        rows.sort(key=lambda r: r[2].sum, reverse=True)
+
+        lines = [
+            "%-60s %8s %10s %10s %10s"
+            % ("check", "count", "total", "p95 wait", "p95 exec")
+        ]
+        for name, wait, execution in rows[:top]:
+            lines.append(
+                "%-60s %8s %10.2f %10s %10s"
+                % (
+                    name[:60],
+                    execution.count,
+                    execution.sum,
+                    wait.quantile(0.95),
+                    execution.quantile(0.95),
+                )
+            )
+
+        return "\n".join(lines) + "\n"
 
     async def read_results(self, callback):
+        """Callback((id, result)) as soon as each result is ready. Callback may
+        be a coroutine function, in which case it is awaited."""
         while True:
-            try:
-                while True:
-                    response = self.result_queue.get_nowait()
-                    callback(response)
-            except queue.Empty:
-                pass
-            except ItemExpired:
-                pass
+            response, expiry = await self.result_queue.get()
 
-            # There's got to be a better way! (Spills milk everywhere)
-            await asyncio.sleep(0.01)
+            if monotonic() > expiry:
+                continue
+
+            ret = callback(response)
+            if asyncio.iscoroutine(ret):
+                await ret
 
 
 class Alerter(object):
     """ABC for sending alerts that require human intervention. Will throttle
     events from the same given context by interval. Example contexts: worker,
-    healthcheck ID"""
-
-    def __init__(self, name, interval="12h", deploy_snooze=3600):
+    healthcheck ID
+
+    Once deliver() is running, alerts are queued and sent from a thread pool
+    of `concurrency` threads per alerter, so a slow API cannot stall the event
+    loop. Each recipient is sent to separately, with a timeout, and retried up
+    to `retries` times with exponential backoff starting at `backoff` seconds.
+    A send that timed out is waited for, not repeated, while still running.
+
+    Alerts raised within `digest_window` seconds of the first are coalesced
+    into one digest message, so an incident affecting many healthchecks costs
+    one message per recipient rather than one per healthcheck.
+    """
+
+    def __init__(
+        self,
+        name,
+        interval="12h",
+        deploy_snooze=3600,
+        concurrency=2,
+        timeout=10,
+        retries=3,
+        backoff=5,
+        queue_size=1000,
+        digest_window=10,
+        digest_reasons=3,
+    ):
         # last notification times by context
         # time is monotonic unix timestamp
         # preloaded with now -- so alerts come at least interval after
         # deplotyment
         self.start = monotonic()
         self.interval = machine_seconds(interval)
-        self.last_notifications = defaultdict(
-            lambda: self.start - self.interval + deploy_snooze
-        )
+        self.snoozed = self.start - self.interval + deploy_snooze
+        self.last_notifications = defaultdict(lambda: self.snoozed)
 
         # name of system (domain name)
         self.name = name
 
-    def alert(self, context, text):
+        self.concurrency = concurrency
+        self.timeout = machine_seconds(timeout)
+        self.retries = retries
+        self.backoff = machine_seconds(backoff)
+        self.queue_size = queue_size
+        self.digest_window = machine_seconds(digest_window)
+        self.digest_reasons = digest_reasons
+
+        # (entity, text) of alerts in the current digest window
+        self.pending = list()
+        self.loop = None
+
+        # (text, recipient, time queued), created by deliver()
+        self.queue = None
+        self.executor = None
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.digests = 0
+        # seconds from alert to delivery
+        self.last_latency = 0
+        self.max_latency = 0
+        self.latency = Histogram(CHECK_BUCKETS)
+
+    def snapshot(self):
+        "Throttle state by context of sent notifications, as unix times"
+        offset = time() - monotonic()
+        return {
+            c: t + offset
+            for c, t in self.last_notifications.items()
+            if t != self.snoozed
+        }
+
+    def restore(self, state):
+        offset = time() - monotonic()
+        for c, t in state.items():
+            self.last_notifications[c] = t - offset
+
+    def alert(self, context, text, entity=None):
         if self.last_notifications[context] < monotonic() - self.interval:
             self.last_notifications[context] = monotonic()
             log.info("Broadcasting alert: %s", text)
-            self.broadcast_alert(text)
+
+            if self.queue is None:
+                self.broadcast_alert(text)
+                return
+
+            if not self.digest_window:
+                self._queue(text)
+                return
+
+            if not self.pending:
+                self.loop.call_later(self.digest_window, self._flush_digest)
+
+            self.pending.append((entity, text))
         else:
             log.debug("Alert throttled: %s (interval:%s)", text, self.interval)
 
+    def _flush_digest(self):
+        pending, self.pending = self.pending, list()
+
+        if len(pending) == 1:
+            self._queue(pending[0][1])
+            return
+
+        self.digests += 1
+        self._queue(self.digest(pending))
+
+    def digest(self, pending):
+        "Summarise [(entity, text)] of alerts in a single message"
+        counts = OrderedDict()
+        for entity, text in pending:
+            counts[entity] = counts.get(entity, 0) + 1
+
+        entities = ", ".join(
+            "%s (%s)" % (entity or "other", n) for entity, n in counts.items()
+        )
+        reasons = "; ".join(text.strip() for e, text in pending[: self.digest_reasons])
+
+        if len(pending) > self.digest_reasons:
+            reasons += "; and %s more" % (len(pending) - self.digest_reasons)
+
+        # trailing space stops iOS previews, see Index.dispatch_result
+        return "%s alerts on %s: %s. %s " % (len(pending), self.name, entities, reasons)
+
+    def _queue(self, text):
+        if self.queue is None:
+            self.broadcast_alert(text)
+            return
+
+        for recipient in self.recipients():
+            try:
+                self.queue.put_nowait((text, recipient, monotonic()))
+            except asyncio.QueueFull:
+                self.dropped += 1
+                log.warn("%s queue full, dropped alert: %s", self, text)
+
+    def recipients(self):
+        "Alerts are delivered and retried separately for each recipient"
+        return [None]
+
+    def send_alert(self, text, recipient):
+        "Send to a single recipient. Blocking; raise on failure to retry."
+        self.broadcast_alert(text)
+
     def broadcast_alert(self, text):
         raise NotImplemented()
+
+    async def deliver(self):
+        "Deliver queued alerts until cancelled"
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        senders = [
+            asyncio.ensure_future(self._sender()) for x in range(self.concurrency)
+        ]
+
+        try:
+            await asyncio.gather(*senders)
+        finally:
+            for sender in senders:
+                sender.cancel()
+            self.queue = None
+            self.executor.shutdown(wait=False)
+
+    async def _sender(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            text, recipient, queued = await self.queue.get()
+            send = None
+
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.retried += 1
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+                # a send that timed out can still be running in its thread and
+                # succeed; wait for it again rather than risk a duplicate
+                if send is None or send.done() and send.exception():
+                    send = loop.run_in_executor(
+                        self.executor, self.send_alert, text, recipient
+                    )
+
+                try:
+                    await asyncio.wait_for(asyncio.shield(send), self.timeout)
+                except Exception as e:
+                    log.warn(
+                        "%s delivery failed (attempt %s): %s",
+                        self,
+                        attempt + 1,
+                        repr(e),
+                    )
+                    continue
+
+                self.sent += 1
+                self.last_latency = monotonic() - queued
+                self.max_latency = max(self.max_latency, self.last_latency)
+                self.latency.observe(self.last_latency)
+                break
+            else:
+                self.failed += 1
+                log.error("%s gave up delivering alert: %s", self, text)
+
+                # still running; its outcome is no longer of interest
+                send.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "digests": self.digests,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+        }
+
+    def __str__(self):
+        return self.__class__.__name__
@@ -6,7 +6,7 @@ USER_CONFIG = CONFIG_DIR = ASSET_DIR = SCRIPT_DIR = STATIC_DIR = TEMPLATES_DIR =
 
 if len(sys.argv) >= 2:
     with open(sys.argv[1]) as f:
-        USER_CONFIG = yaml.load(f.read())
+        USER_CONFIG = yaml.safe_load(f.read())
 
     CONFIG_DIR = path.realpath(path.dirname(sys.argv[1]))
     # TODO ASSET_DIR yes or no? -- could just be local to yml file
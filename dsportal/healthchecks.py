@@ -4,21 +4,24 @@ from dsportal.util import bar_percent
 from dsportal.util import human_bytes
 from dsportal.util import human_seconds
 from dsportal.util import machine_seconds
+from dsportal.util import parse_ports
+from dsportal.util import get_boto3_client
+from dsportal.host import sampler
 from dsportal import __version__ as version
 from whois import whois
 import socket
 from datetime import datetime
-import re
 import os
-import multiprocessing
-import requests
 from subprocess import run, PIPE
 from urllib.parse import urlparse
-from time import sleep, mktime, time
-import boto3
+from time import time, strftime, gmtime
+from threading import Lock
+import json
 import xml.etree.ElementTree as ET
 import urllib
 import ssl
+import asyncio
+import aiohttp
 
 
 class RamUsage(HealthCheck):
@@ -31,16 +34,8 @@ class RamUsage(HealthCheck):
     @staticmethod
     def check():
         # http://www.linuxatemyram.com/
-        with open("/proc/meminfo") as f:
-            lines = f.readlines()
-
         # in kB
-        info = {}
-
-        for line in lines:
-            m = re.search("(\w+):\s*(\d+)", line)
-            if m:
-                info[m.group(1)] = int(m.group(2))
+        info = sampler.snapshot()["meminfo"]
 
         used = info["MemTotal"] - info["MemFree"] - info["Buffers"] - info["Cached"]
 
@@ -68,27 +63,37 @@ class RamUsage(HealthCheck):
 
 
 class CpuUsage(HealthCheck):
-    """Checks number of waiting processes per thread is less than 3
+    """Checks CPU busy time since the previous check is below a threshold.
+
+    Args:
+        _max (int): Busy percentage at which to fail check
+        per_core (bool): Include busy, iowait and steal percentages of each core
     """
 
     label = "CPU Utilisation"
     description = "Checks CPU load is nominal."
 
+    # usage is measured since the previous check of this healthcheck
+    stateful = True
+
     @staticmethod
-    def check(_max=300):
-        # "return normalised % load (avg num of processes waiting per processor)"
-        load = os.getloadavg()[0]
-        load = load / multiprocessing.cpu_count()
-        value = int(load * 100)
+    def check(_max=90, per_core=False, check_key=None):
+        snapshot = sampler.cpu(check_key)
+        usage = snapshot["cpu"]
+        value = int(usage["busy"])
 
         status = {
             "value": "%s%%" % value,
             "bar_min": "0%",
             "bar_max": "100%",
             "bar_percent": bar_percent(value, 100),
-            "healthy": value < _max,
+            "iowait": usage["iowait"],
+            "steal": usage["steal"],
         }
 
+        if per_core:
+            status["cores"] = snapshot["cores"]
+
         if value < _max:
             status["healthy"] = True
             status["reason"] = "CPU usage nominal"
@@ -205,11 +210,7 @@ class Uptime(HealthCheck):
 
     @staticmethod
     def check():
-        with open("/proc/uptime", "r") as f:
-            line = f.readline()
-
-        seconds = line.partition(" ")[0]
-        seconds = float(seconds)
+        seconds = sampler.snapshot()["uptime"]
 
         days = int(round(seconds / 86400))
 
@@ -229,17 +230,14 @@ class CpuTemperature(HealthCheck):
 
     @staticmethod
     def check(zone=None, slowdown=80, _max=90):
+        thermal = sampler.snapshot()["thermal"]
+
         # search for hottest or use given zone
         hottest = 0
         for x in [zone] if zone else range(3):
-            try:
-                with open("/sys/class/thermal/thermal_zone%s/temp" % x) as f:
-                    reading = f.read()
-                    value = int(reading.strip()[:-3])
-                    if value > hottest:
-                        hottest = value
-            except OSError:
-                continue
+            value = thermal.get(int(x), 0)
+            if value > hottest:
+                hottest = value
 
         if not hottest:
             raise Exception("Could not find any thermal zone")
@@ -344,7 +342,8 @@ class HttpStatus(HealthCheck):
         self.check_kwargs["url"] = kwargs.get("url", self.entity.url)
 
     @staticmethod
-    def check(
+    async def check(
+        session,
         url,
         status_code=200,
         timeout=10,
@@ -358,51 +357,55 @@ class HttpStatus(HealthCheck):
         # experienced on t2.micro in AWS.
         ua = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"
 
-        kwargs = {"url": url, "timeout": timeout, "headers": {"User-Agent": ua}}
+        kwargs = {"url": url, "headers": {"User-Agent": ua}}
 
         if client_crt:
-            kwargs["cert"] = (client_crt, client_key)
+            context = ssl.create_default_context()
+            context.load_cert_chain(client_crt, client_key)
+            kwargs["ssl"] = context
+
+        async def get():
+            async with session.get(**kwargs) as r:
+                return r.status, r.reason, await r.text()
 
         try:
-            r = requests.get(**kwargs)
-        except:
-            sleep(1)
+            status, reason, text = await asyncio.wait_for(get(), timeout)
+        except Exception:
+            await asyncio.sleep(1)
             try:
-                r = requests.get(**kwargs)
-            except requests.exceptions.ProxyError:
+                status, reason, text = await asyncio.wait_for(get(), timeout)
+            except aiohttp.ClientProxyConnectionError:
                 # indicates a local problem and therefore the test is invalid
                 # and health is unknown.
                 raise
-            except requests.exceptions.SSLError as e:
+            except aiohttp.ClientSSLError as e:
                 return {"healthy": False, "reason": "Failed to verify SSL connection"}
-            except requests.exceptions.ReadTimeout as e:
-                return {"healthy": False, "reason": "Read timed out"}
-            except requests.exceptions.ConnectTimeout as e:
-                return {"healthy": False, "reason": "Connection timed out"}
-            except requests.exceptions.TooManyRedirects as e:
+            except asyncio.TimeoutError as e:
+                return {"healthy": False, "reason": "Request timed out"}
+            except aiohttp.TooManyRedirects as e:
                 return {"healthy": False, "reason": "Redirect loop detected"}
             # actually a parent of many above
-            except requests.exceptions.ConnectionError as e:
+            except aiohttp.ClientError as e:
                 return {"healthy": False, "reason": "Connection failed"}
 
-        if r.status_code != status_code:
-            if r.status_code == 200:
+        if status != status_code:
+            if status == 200:
                 return {
                     "healthy": False,
                     "value": 200,
                     "reason": "Unexpected 200 OK received",
                 }
             else:
-                return {"healthy": False, "value": r.status_code, "reason": r.reason}
+                return {"healthy": False, "value": status, "reason": reason}
 
-        if contains and contains not in r.text:
+        if contains and contains not in text:
             return {
                 "healthy": False,
-                "value": r.status_code,
+                "value": status,
                 "reason": "Unexpected page content despite correct HTTP status",
             }
 
-        return {"healthy": True, "value": r.status_code}
+        return {"healthy": True, "value": status}
 
 
 class BrokenLinks(HealthCheck):
@@ -422,12 +425,27 @@ class BrokenLinks(HealthCheck):
 # run every 5 hours
 
 
+# (bucket, prefix, client kwargs) -> (last key listed, newest LastModified,
+# time last listed) for incremental S3BackupChecker listings
+_s3_listings = dict()
+_s3_listings_lock = Lock()
+
+# seconds after which a prefix not listed, eg a past date partition, is
+# forgotten. Listing it again then starts from the beginning.
+S3_LISTING_TTL = 2 * 86400
+
+
 class S3BackupChecker(HealthCheck):
     """Checks to see that a backup was made recently
 
         Args:
             bucket (str): Name of s3 bucket to check
             age (str): Time in short notation before a backup is considered too old.
+            prefix (str): Only consider keys starting with this prefix
+            key_template (str): strftime template of date-partitioned keys
+                after prefix, eg "%Y/%m/%d/". Only partitions within age are listed.
+            incremental (bool): Remember the last key listed and only list keys
+                after it next time. Requires new backups to sort after old ones.
             **client_kwargs (dict): additional kwargs to pass onto boto3.client
     """
 
@@ -435,23 +453,87 @@ class S3BackupChecker(HealthCheck):
     interval = 3600
 
     @staticmethod
-    def check(bucket, age="25h", **client_kwargs):
-        # list keys in bucket and check the latest upload was < 25 hours ago.
-        client = boto3.client(service_name="s3", **client_kwargs)
+    def check(
+        bucket,
+        age="25h",
+        prefix="",
+        key_template=None,
+        incremental=False,
+        **client_kwargs
+    ):
+        client = get_boto3_client("s3", **client_kwargs)
+        max_age = machine_seconds(age)
+
+        if key_template:
+            # newest partitions first, in steps of an hour back to max age
+            prefixes = list()
+            for hours in range(int(max_age // 3600) + 2):
+                p = prefix + strftime(key_template, gmtime(time() - hours * 3600))
+                if p not in prefixes:
+                    prefixes.append(p)
+        else:
+            prefixes = [prefix]
+
+        latest = 0
+        for p in prefixes:
+            if incremental:
+                latest = S3BackupChecker._list_incremental(
+                    client, bucket, p, client_kwargs
+                )
+            else:
+                latest, _ = S3BackupChecker._list_latest(client, bucket, p)
+
+            if latest:
+                break
+
+        if not latest:
+            return {"healthy": False, "reason": "No backups found"}
+
+        return {
+            "healthy": time() - latest < max_age,
+            "reason": "backup was %s old" % human_seconds(time() - latest),
+        }
 
+    @staticmethod
+    def _list_latest(client, bucket, prefix, **list_kwargs):
+        "Returns (newest LastModified, last key) of keys under prefix"
         paginator = client.get_paginator("list_objects_v2")
 
         latest = 0
-        for page in paginator.paginate(Bucket=bucket):
-            for obj in page["Contents"]:
-                timestamp = mktime(obj["LastModified"].timetuple())
+        last_key = None
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **list_kwargs):
+            for obj in page.get("Contents", []):
+                timestamp = obj["LastModified"].timestamp()
                 if timestamp > latest:
                     latest = timestamp
+                last_key = obj["Key"]
 
-        return {
-            "healthy": time() - latest < machine_seconds(age),
-            "reason": "backup was %s old" % human_seconds(time() - latest),
-        }
+        return latest, last_key
+
+    @staticmethod
+    def _list_incremental(client, bucket, prefix, client_kwargs):
+        key = bucket, prefix, json.dumps(client_kwargs, sort_keys=True)
+
+        with _s3_listings_lock:
+            last_key, latest, _ = _s3_listings.get(key, ("", 0, 0))
+
+        list_kwargs = {"StartAfter": last_key} if last_key else {}
+        new_latest, new_last_key = S3BackupChecker._list_latest(
+            client, bucket, prefix, **list_kwargs
+        )
+
+        latest = max(latest, new_latest)
+        now = time()
+
+        with _s3_listings_lock:
+            _s3_listings[key] = new_last_key or last_key, latest, now
+
+            for old in [
+                k for k, v in _s3_listings.items() if now - v[2] > S3_LISTING_TTL
+            ]:
+                del _s3_listings[old]
+
+        return latest
 
 
 class PapouchTh2eTemperature(HealthCheck):
@@ -467,10 +549,13 @@ class PapouchTh2eTemperature(HealthCheck):
     label = "Temperature"
 
     @staticmethod
-    def check(host, _min=10, _max=35):
-        r = requests.get("http://%s/fresh.xml" % host, timeout=5)
-        r.raise_for_status()
-        root = ET.fromstring(r.text)
+    async def check(session, host, _min=10, _max=35):
+        async def get():
+            async with session.get("http://%s/fresh.xml" % host) as r:
+                r.raise_for_status()
+                return await r.text()
+
+        root = ET.fromstring(await asyncio.wait_for(get(), 5))
         value = root[0].attrib["val"]
         value = int(float(value))
 
@@ -483,17 +568,31 @@ class PapouchTh2eTemperature(HealthCheck):
         }
 
 
+# host -> (expiry, report) of finished SSL Labs scans
+_ssllabs_reports = dict()
+# host -> future of the report of a scan being polled
+_ssllabs_polls = dict()
+
+
 class SsllabsReport(HealthCheck):
-    """Checks SSL implementation using ssllabs.org
+    """Checks SSL implementation using ssllabs.org. Scans take minutes, so the
+    scan is polled from the event loop rather than a worker thread, and reports
+    are shared by checks of the same host until max_age.
 
         Args:
             host (str): Host or IP address to scan
             min_grade (str): Minimum grade necessary (A+, A-, A-F, T, M)
+            max_age (str): Reuse reports younger than this, from SSL Labs or
+                a previous check
+            poll (int): Seconds between polls while the scan is in progress
+            timeout (str): Give up on a scan after this long
     """
 
     label = "SSL implementation"
     interval = 24 * 3600
 
+    api = "https://api.ssllabs.com/api/v2/analyze"
+
     def __init__(self, **kwargs):
         super(SsllabsReport, self).__init__(**kwargs)
         url = kwargs.get("url", self.entity.url)
@@ -501,58 +600,179 @@ class SsllabsReport(HealthCheck):
             self.check_kwargs["host"] = urlparse(url).hostname
 
     @staticmethod
-    def check(host, min_grade="A+"):
+    async def check(
+        session, host, min_grade="A+", max_age="23h", poll=10, timeout="15m"
+    ):
         grades = ["A+", "A", "A-", "B", "C", "D", "E", "F", "T", "M"]
         grades = dict(zip(grades, range(len(grades))))  # grade -> score
 
-        for x in range(100):
-            response = requests.get(
-                "https://api.ssllabs.com/api/v2/analyze",
-                params={"host": host},
-                timeout=5,
-            )
-            response.raise_for_status()
-            report = response.json()
-            sleep(2)
+        expiry, report = _ssllabs_reports.get(host, (0, None))
+
+        if expiry < time():
+            # join a poll already running for the host
+            scan = _ssllabs_polls.get(host)
+
+            if not scan:
+                scan = asyncio.ensure_future(
+                    SsllabsReport._scan(session, host, max_age, poll, timeout)
+                )
+                scan.add_done_callback(lambda f: _ssllabs_polls.pop(host, None))
+                _ssllabs_polls[host] = scan
+
+            # shielded so one check being cancelled does not cancel the scan
+            report = await asyncio.shield(scan)
+
+        grade = report["endpoints"][0]["grade"]
+
+        return {"healthy": grades[grade] <= grades[min_grade], "value": grade}
+
+    @staticmethod
+    async def _scan(session, host, max_age, poll, timeout):
+        "Start or fetch a cached scan, then poll until READY or ERROR"
+        params = {
+            "host": host,
+            "fromCache": "on",
+            "maxAge": max(1, machine_seconds(max_age) // 3600),
+        }
+        deadline = time() + machine_seconds(timeout)
+
+        async def get():
+            async with session.get(SsllabsReport.api, params=params) as r:
+                if r.status in (429, 503, 529):
+                    # rate limited or overloaded, try again later
+                    return {"status": "BUSY"}
+
+                r.raise_for_status()
+                return await r.json()
+
+        while True:
+            report = await asyncio.wait_for(get(), 10)
 
             if report["status"] == "READY":
-                break
+                _ssllabs_reports[host] = time() + machine_seconds(max_age), report
+                return report
 
             if report["status"] == "ERROR":
                 raise Exception(report["statusMessage"])
-        else:
-            raise TimeoutError("SSL labs test took too long")
 
-        grade = report["endpoints"][0]["grade"]
+            if time() > deadline:
+                raise TimeoutError("SSL labs test took too long")
 
-        return {"healthy": grades[grade] <= grades[min_grade], "value": grade}
+            # poll without restarting the scan, once it has been accepted
+            if report["status"] != "BUSY":
+                params = {"host": host}
+
+            await asyncio.sleep(poll)
 
 
 class PortScan(HealthCheck):
-    """Scans host to check ports are closed. Synchronous so relatively quiet/slow.
+    """Scans hosts to check ports are closed. Connects are concurrent but
+    rate limited, so the scan stays relatively quiet.
 
         Args:
             host (str): Host or IP address to scan
-            open_ports (list): list of (int) ports that must be open
-            wait (float): Seconds to wait between port checks
+            hosts (list): Additional hosts to scan in the same run
+            open_ports (list): list of (int) ports that are allowed to be open
+            ports (str): Ports to scan, eg "1-1024,8080". Default 1-limit.
+            concurrency (int): Max number of connects in flight
+            rate (float): Max number of connects started per second
+            timeout (float): Seconds to wait for each connect
+            early_exit (bool): Stop at the first unexpected open port
+            wait (float): Seconds between connects. Deprecated, use rate.
     """
 
     label = "Firewall"
     interval = 24 * 3600
 
     @staticmethod
-    def check(host, open_ports=[22, 80, 443], limit=65535, wait=0.5):
-        for port in range(1, limit + 1):
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    async def check(
+        session,
+        host=None,
+        hosts=[],
+        open_ports=[22, 80, 443],
+        ports=None,
+        limit=65535,
+        concurrency=200,
+        rate=1000,
+        timeout=0.5,
+        early_exit=False,
+        wait=None,
+    ):
+        loop = asyncio.get_event_loop()
+
+        # resolve once rather than per connect
+        targets = list()
+        for name in ([host] if host else []) + hosts:
+            info = await loop.getaddrinfo(name, None, type=socket.SOCK_STREAM)
+            targets.append((name, info[0][4][0]))
+
+        if not targets:
+            raise ValueError("host or hosts must be given")
+
+        ports = parse_ports(ports) if ports else range(1, limit + 1)
+        rate = 1 / wait if wait else rate
+
+        unexpected = list()
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = set()
+
+        async def probe(name, address, port):
             try:
-                sock.settimeout(0.5)
-                result = sock.connect_ex((host, port))
-                if result == 0 and port not in open_ports:
-                    raise Exception("At least port %s is open but should not be" % port)
-            except:
-                raise
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address, port), timeout
+                )
+                writer.close()
+            except (OSError, asyncio.TimeoutError):
+                return
             finally:
-                sock.close()
+                semaphore.release()
+
+            if port not in open_ports:
+                unexpected.append("%s:%s" % (name, port))
+
+        next_start = loop.time()
+
+        try:
+            # interleave hosts to spread load on each
+            probes = ((n, a, p) for p in ports for n, a in targets)
+
+            for name, address, port in probes:
+                await semaphore.acquire()
+
+                next_start = max(next_start + 1 / rate, loop.time())
+                if next_start > loop.time():
+                    await asyncio.sleep(next_start - loop.time())
+
+                # probes in flight may have found one while waiting
+                if early_exit and unexpected:
+                    semaphore.release()
+                    break
+
+                task = asyncio.ensure_future(probe(name, address, port))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            # on early exit, probes still in flight are cancelled below
+            if tasks and not (early_exit and unexpected):
+                await asyncio.wait(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if unexpected:
+            return {
+                "healthy": False,
+                "value": "%s open" % len(unexpected),
+                "reason": "Unexpected open ports: %s%s"
+                % (", ".join(unexpected[:10]), "..." if len(unexpected) > 10 else ""),
+                "unexpected_open_ports": unexpected,
+            }
+
+        return {
+            "healthy": True,
+            "value": "OK",
+            "reason": "No unexpected open ports on %s hosts" % len(targets),
+        }
 
 
 class Systemd(HealthCheck):
@@ -613,8 +833,9 @@ class DomainExpiryCheck(HealthCheck):
     """Checks a domain is not about to expire"""
 
     label = "Domain expiry"
-    # TODO  -- shorter interval when failing (and longer when OK)
     interval = 3600
+    min_interval = 600
+    max_interval = 12 * 3600
 
     def __init__(self, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
@@ -655,15 +876,16 @@ class CertificateExpiryCheck(HealthCheck):
         self.check_kwargs["domain"] = kwargs.get("domain", domain)
 
     @staticmethod
-    def check(domain, margin="2w"):
+    async def check(session, domain, margin="2w"):
         margin = machine_seconds(margin)
         context = ssl.create_default_context()
-        conn = context.wrap_socket(
-            socket.socket(socket.AF_INET), server_hostname=domain
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(domain, 443, ssl=context), 5
         )
-        conn.settimeout(5)
-        conn.connect((domain, 443))
-        ssl_info = conn.getpeercert()
+        try:
+            ssl_info = writer.get_extra_info("peercert")
+        finally:
+            writer.close()
         expiry = datetime.strptime(
             ssl_info["notAfter"], r"%b %d %H:%M:%S %Y %Z"
         ).timestamp()
@@ -680,16 +902,24 @@ class ElasticSearchHealth(HealthCheck):
     label = "Elastic search health"
 
     @staticmethod
-    def check(base_url, client_crt=None, client_key=None):
+    async def check(session, base_url, client_crt=None, client_key=None):
         url = os.path.join(base_url, "_cluster/health")
 
+        kwargs = {"url": url}
+
+        if client_crt:
+            context = ssl.create_default_context()
+            context.load_cert_chain(client_crt, client_key)
+            kwargs["ssl"] = context
+
         # if this fails, it will throw an exception and dsportal will treat
         # this as UNKNOWN -- which is true. The endpoint should be monitored separately with HttpStatus
-        r = requests.get(
-            url=url, timeout=10, cert=(client_crt, client_key) if client_crt else None
-        )
-        r.raise_for_status()
-        j = r.json()
+        async def get():
+            async with session.get(**kwargs) as r:
+                r.raise_for_status()
+                return await r.json()
+
+        j = await asyncio.wait_for(get(), 10)
 
         return {
             # warning would be yellow, and fail red.
@@ -712,11 +942,14 @@ class GithubExposureCheck(HealthCheck):
     interval = 84600
 
     @staticmethod
-    def check(username, expected_repos=[]):
-        r = requests.get("https://api.github.com/users/%s/repos" % username, timeout=5)
-        r.raise_for_status()
+    async def check(session, username, expected_repos=[]):
+        async def get():
+            url = "https://api.github.com/users/%s/repos" % username
+            async with session.get(url) as r:
+                r.raise_for_status()
+                return await r.json()
 
-        repos_exposed = [repo["name"] for repo in r.json()]
+        repos_exposed = [repo["name"] for repo in await asyncio.wait_for(get(), 5)]
 
         for repo in repos_exposed:
             if repo not in expected_repos:
@@ -736,23 +969,14 @@ class PortCheck(HealthCheck):
     interval = 600
 
     @staticmethod
-    def check(host, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    async def check(session, host, port):
         try:
-            sock.settimeout(5)
-            result = sock.connect_ex((host, port))
-            if result == 0:
-                return {
-                    "healthy": True,
-                    "reason": "Network is responding",
-                    "value": "Online",
-                }
-            else:
-                return {
-                    "healthy": True,
-                    "reason": "Network is down",
-                    "value": "Offline",
-                }
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), 5
+            )
+        except (OSError, asyncio.TimeoutError):
+            return {"healthy": True, "reason": "Network is down", "value": "Offline"}
 
-        finally:
-            sock.close()
+        writer.close()
+
+        return {"healthy": True, "reason": "Network is responding", "value": "Online"}
@@ -0,0 +1,365 @@
+"""
+Compact history of healthcheck results. Every healthcheck has a fixed-size
+ring buffer of raw samples plus rollups at 1 minute, 1 hour and 1 day
+resolution for longer retention. Rings for all healthchecks are rows of
+memory-mapped .npy files, so history survives restarts and costs 9 bytes per
+raw sample.
+
+Healthchecks are identified by HealthCheck.key, which is stable across
+restarts.
+
+record() only buffers a sample; write() applies buffered samples to the rings
+in one vectorised batch and is meant to run off the event loop.
+"""
+from collections import OrderedDict
+from collections import defaultdict
+from threading import Lock
+from os import path
+from os import makedirs
+from os import replace
+from time import time
+import numpy as np
+import json
+import re
+import logging
+
+log = logging.getLogger(__name__)
+
+SAMPLE = np.dtype([("time", "<u4"), ("healthy", "i1"), ("value", "<f4")])
+
+ROLLUP = np.dtype(
+    [
+        ("time", "<u4"),
+        ("count", "<u4"),
+        ("healthy", "<u4"),
+        ("unhealthy", "<u4"),
+        ("values", "<u4"),
+        ("min", "<f4"),
+        ("max", "<f4"),
+        ("sum", "<f4"),
+    ]
+)
+
+# name -> bucket width in seconds, number of buckets kept
+ROLLUPS = OrderedDict(
+    [("1m", (60, 720)), ("1h", (3600, 24 * 30)), ("1d", (86400, 730))]
+)
+
+HEALTHY_CODES = {True: 1, False: 0, None: -1}
+HEALTHY_VALUES = {1: True, 0: False, -1: None}
+
+# rows are allocated in chunks so healthchecks added at runtime rarely
+# require a resize
+CHUNK = 1024
+
+# samples written per numpy operation by History.write(). Each operation holds
+# the GIL, which stalls the event loop for the page faults of the first writes
+# to new rows.
+WRITE_CHUNK = 1000
+
+
+def numeric_value(result):
+    "Extract a number from a result for graphing, or NaN"
+    if "bytes" in result:
+        return float(result["bytes"])
+
+    value = result.get("value")
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+
+    if isinstance(value, str):
+        m = re.match(r"\s*(-?\d+(\.\d+)?)", value)
+        if m:
+            return float(m.group(1))
+
+    return float("nan")
+
+
+class Ring(object):
+    "A ring buffer per row, stored in a pair of memory-mapped .npy files"
+
+    def __init__(self, filepath, dtype, length, rows):
+        self.filepath = filepath
+        self.dtype = dtype
+        self.length = length
+        self.data = None
+        self.heads = None
+        self.open(rows)
+
+    def open(self, rows):
+        data_file = self.filepath + ".npy"
+        heads_file = self.filepath + ".heads.npy"
+
+        data = heads = None
+
+        if path.exists(data_file) and path.exists(heads_file):
+            data = np.lib.format.open_memmap(data_file, mode="r+")
+            heads = np.lib.format.open_memmap(heads_file, mode="r+")
+
+            if data.dtype != self.dtype or data.shape[1] != self.length:
+                log.warn("History format of %s changed, discarding", data_file)
+                data = heads = None
+
+        if data is not None and data.shape[0] >= rows:
+            self.data, self.heads = data, heads
+            return
+
+        rows = (rows // CHUNK + 1) * CHUNK
+
+        new_data = np.lib.format.open_memmap(
+            data_file + ".tmp", mode="w+", dtype=self.dtype, shape=(rows, self.length)
+        )
+        new_heads = np.lib.format.open_memmap(
+            heads_file + ".tmp", mode="w+", dtype="<i4", shape=(rows,)
+        )
+
+        if data is not None:
+            new_data[: data.shape[0]] = data
+            new_heads[: heads.shape[0]] = heads
+
+        new_data.flush()
+        new_heads.flush()
+
+        replace(data_file + ".tmp", data_file)
+        replace(heads_file + ".tmp", heads_file)
+
+        self.data = new_data
+        self.heads = new_heads
+
+    def advance(self, rows):
+        "Advance the heads of rows, which must be unique. Returns the heads."
+        heads = (self.heads[rows] + 1) % self.length
+        self.heads[rows] = heads
+        return heads
+
+    def flush(self):
+        self.data.flush()
+        self.heads.flush()
+
+    def wrapped(self, row):
+        "True once samples of row have been overwritten"
+        # heads start at 0 and advance before writing, so slot 0 is filled last
+        return self.data["time"][row, 0] > 0
+
+    def oldest(self, row):
+        times = self.data["time"][row]
+        times = times[times > 0]
+        return int(times.min()) if len(times) else None
+
+    def select(self, row, start, end):
+        data = self.data[row]
+        mask = (data["time"] >= start) & (data["time"] <= end) & (data["time"] > 0)
+        return np.sort(data[mask], order="time")
+
+
+class History(object):
+    def __init__(self, directory, length=1440, max_pending=100000):
+        """
+        Args:
+            directory (str): Where to keep memory-mapped history files
+            length (int): Number of raw samples to keep per healthcheck
+            max_pending (int): Samples buffered before record() drops them
+        """
+        self.directory = directory
+        self.max_pending = max_pending
+
+        # (row, time, healthy code, value) not yet written
+        self.pending = list()
+        self.dropped = 0
+        # held while rings are written or resized
+        self.lock = Lock()
+
+        if not path.isdir(directory):
+            makedirs(directory)
+
+        self.slots_file = path.join(directory, "slots.json")
+
+        # healthcheck key -> row in every ring
+        try:
+            with open(self.slots_file) as f:
+                self.slots = json.load(f)
+        except FileNotFoundError:
+            self.slots = dict()
+
+        rows = len(self.slots)
+
+        self.raw = Ring(path.join(directory, "raw"), SAMPLE, length, rows)
+        self.rollups = OrderedDict(
+            (name, (width, Ring(path.join(directory, name), ROLLUP, length, rows)))
+            for name, (width, length) in ROLLUPS.items()
+        )
+
+    def register(self, keys):
+        "Allocate rows for healthchecks by key. Returns rows."
+        new = [k for k in keys if k not in self.slots]
+
+        if new:
+            for key in new:
+                self.slots[key] = len(self.slots)
+
+            with self.lock:
+                for ring in self.rings():
+                    ring.open(len(self.slots))
+
+            with open(self.slots_file + ".tmp", "w") as f:
+                json.dump(self.slots, f)
+
+            replace(self.slots_file + ".tmp", self.slots_file)
+
+        return [self.slots[k] for k in keys]
+
+    def rings(self):
+        yield self.raw
+        for width, ring in self.rollups.values():
+            yield ring
+
+    def flush(self):
+        for ring in self.rings():
+            ring.flush()
+
+    def record(self, key, result, t=None):
+        "Buffer a sample, to be written by write()"
+        row = self.slots.get(key)
+        if row is None:
+            row = self.register([key])[0]
+
+        if len(self.pending) >= self.max_pending:
+            if not self.dropped:
+                log.warn("History writes are falling behind, dropping samples")
+            self.dropped += 1
+            return
+
+        self.pending.append(
+            (
+                row,
+                int(t or time()),
+                HEALTHY_CODES[result["healthy"]],
+                numeric_value(result),
+            )
+        )
+
+    def take(self):
+        "Returns buffered samples for write(), emptying the buffer"
+        samples, self.pending = self.pending, list()
+        return samples
+
+    def write(self, samples=None):
+        """Write samples from take() to the rings, or all buffered samples.
+        Safe to run in a thread while samples are recorded."""
+        if samples is None:
+            samples = self.take()
+
+        # vectorised updates need unique rows; a healthcheck with several
+        # samples in the batch has them written in successive rounds
+        rounds = defaultdict(list)
+        seen = defaultdict(int)
+        for sample in samples:
+            rounds[seen[sample[0]]].append(sample)
+            seen[sample[0]] += 1
+
+        with self.lock:
+            for n in sorted(rounds):
+                samples = rounds[n]
+                for i in range(0, len(samples), WRITE_CHUNK):
+                    self._write_round(samples[i : i + WRITE_CHUNK])
+
+    def _write_round(self, samples):
+        rows, t, healthy, value = (np.array(x) for x in zip(*samples))
+
+        # plain views, as indexing a np.memmap is comparatively slow
+        data = self.raw.data.view(np.ndarray)
+        heads = self.raw.advance(rows)
+        data["time"][rows, heads] = t
+        data["healthy"][rows, heads] = healthy
+        data["value"][rows, heads] = value
+
+        numeric = ~np.isnan(value)
+
+        for width, ring in self.rollups.values():
+            data = ring.data.view(np.ndarray)
+            start = t - t % width
+            heads = ring.heads[rows]
+
+            new = data["time"][rows, heads] != start
+            heads[new] = ring.advance(rows[new])
+            data[rows[new], heads[new]] = (0, 0, 0, 0, 0, np.nan, np.nan, 0)
+            data["time"][rows[new], heads[new]] = start[new]
+
+            data["count"][rows, heads] += 1
+            data["healthy"][rows, heads] += healthy == 1
+            data["unhealthy"][rows, heads] += healthy == 0
+
+            r, h, v = rows[numeric], heads[numeric], value[numeric]
+            data["values"][r, h] += 1
+            data["min"][r, h] = np.fmin(data["min"][r, h], v)
+            data["max"][r, h] = np.fmax(data["max"][r, h], v)
+            data["sum"][r, h] += v
+
+    def query(self, key, start=0, end=None, resolution=None):
+        """Samples of a healthcheck between unix times start and end, in time
+        order. If resolution is not given, the finest resolution that covers
+        start is used, or else the finest that has lost no samples, ie covers
+        all history. Returns (resolution, samples)."""
+        end = end or time()
+
+        if key not in self.slots:
+            return resolution or "raw", []
+
+        row = self.slots[key]
+
+        with self.lock:
+            return self._query(row, start, end, resolution)
+
+    def _query(self, row, start, end, resolution):
+        if resolution is None:
+            resolution = list(self.rollups.keys())[-1]
+            for name in ["raw"] + list(self.rollups.keys()):
+                ring = self.ring(name)
+                oldest = ring.oldest(row)
+                if oldest is None or oldest <= start or not ring.wrapped(row):
+                    resolution = name
+                    break
+
+        samples = self.ring(resolution).select(row, start, end)
+
+        if resolution == "raw":
+            return (
+                resolution,
+                [
+                    {
+                        "time": int(s["time"]),
+                        "healthy": HEALTHY_VALUES[int(s["healthy"])],
+                        "value": None if np.isnan(s["value"]) else float(s["value"]),
+                    }
+                    for s in samples
+                ],
+            )
+
+        return (
+            resolution,
+            [
+                {
+                    "time": int(s["time"]),
+                    "count": int(s["count"]),
+                    "healthy": int(s["healthy"]),
+                    "unhealthy": int(s["unhealthy"]),
+                    "unknown": int(s["count"] - s["healthy"] - s["unhealthy"]),
+                    "min": None if not s["values"] else float(s["min"]),
+                    "max": None if not s["values"] else float(s["max"]),
+                    "mean": None if not s["values"] else float(s["sum"] / s["values"]),
+                }
+                for s in samples
+            ],
+        )
+
+    def ring(self, resolution):
+        if resolution == "raw":
+            return self.raw
+
+        try:
+            return self.rollups[resolution][1]
+        except KeyError:
+            raise ValueError(
+                "Resolution must be one of raw, %s" % ", ".join(self.rollups.keys())
+            )
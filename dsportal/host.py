@@ -0,0 +1,154 @@
+"""
+Samples metrics of the host the worker runs on. /proc/meminfo, /proc/loadavg,
+/proc/uptime and the thermal zones are read once per tick into a snapshot
+shared by all local system checks, so checks on the same host cost one set of
+reads per tick rather than one per check.
+
+CPU utilisation is computed from the difference in /proc/stat counters since
+the previous check of the same healthcheck, so it covers the time between its
+checks rather than the minute-scale decay of the load average. The first check
+reports the average since boot.
+
+Set DSPORTAL_HOST_TICK to change the tick in seconds (default 5), which bounds
+how stale a reading can be.
+"""
+from os import getenv
+from threading import Lock
+from time import monotonic
+from glob import glob
+import re
+
+THERMAL_ZONES = "/sys/class/thermal/thermal_zone*/temp"
+
+
+def read_meminfo():
+    "Returns /proc/meminfo in kB, eg {'MemTotal': 16318464, ...}"
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            fields = rest.split()
+            if fields:
+                info[name] = int(fields[0])
+
+    return info
+
+
+def read_loadavg():
+    with open("/proc/loadavg") as f:
+        return tuple(float(x) for x in f.read().split()[:3])
+
+
+def read_uptime():
+    with open("/proc/uptime") as f:
+        return float(f.read().partition(" ")[0])
+
+
+def read_stat():
+    """Returns /proc/stat CPU counters in jiffies as {'cpu': [user, nice,
+    system, idle, iowait, irq, softirq, steal], 'cpu0': [...], ...}"""
+    counters = {}
+    with open("/proc/stat") as f:
+        for line in f:
+            if not line.startswith("cpu"):
+                break
+            fields = line.split()
+            # guest time is already counted in user and nice
+            counters[fields[0]] = [int(x) for x in fields[1:9]]
+
+    return counters
+
+
+def cpu_usage(previous, current):
+    """Busy, iowait and steal percentages between two sets of counters of one
+    CPU"""
+    delta = [c - p for c, p in zip(current, previous or [0] * len(current))]
+    total = sum(delta)
+
+    if total <= 0:
+        return {"busy": 0.0, "iowait": 0.0, "steal": 0.0}
+
+    idle = delta[3] + delta[4]
+
+    return {
+        "busy": round(100 * (total - idle) / total, 1),
+        "iowait": round(100 * delta[4] / total, 1),
+        "steal": round(100 * delta[7] / total, 1),
+    }
+
+
+def read_thermal(paths):
+    "Returns {zone number: temperature in Celcius} of readable zones"
+    temperatures = {}
+    for zone, filepath in paths.items():
+        try:
+            with open(filepath) as f:
+                temperatures[zone] = int(f.read().strip()) // 1000
+        except (OSError, ValueError):
+            continue
+
+    return temperatures
+
+
+class HostSampler(object):
+    """Takes a snapshot of host metrics at most once per tick. Safe to call
+    from any worker thread."""
+
+    def __init__(self, tick=5):
+        self.tick = tick
+        self.lock = Lock()
+        self.sampled = None
+        self.sample = None
+        self.thermal_zones = None
+        # healthcheck id -> (monotonic time, /proc/stat counters) of its
+        # previous check
+        self.stats = dict()
+
+    def snapshot(self):
+        "Returns the latest sample, taking a new one if older than tick"
+        with self.lock:
+            if self.sampled is None or monotonic() - self.sampled >= self.tick:
+                self.sample = self._take()
+                self.sampled = monotonic()
+
+            return self.sample
+
+    def _take(self):
+        if self.thermal_zones is None:
+            self.thermal_zones = {
+                int(re.search(r"thermal_zone(\d+)", p).group(1)): p
+                for p in glob(THERMAL_ZONES)
+            }
+
+        return {
+            "meminfo": read_meminfo(),
+            "loadavg": read_loadavg(),
+            "uptime": read_uptime(),
+            "thermal": read_thermal(self.thermal_zones),
+        }
+
+    def cpu(self, id=None):
+        """Returns usage of all CPUs and of each core since the previous call
+        with the same id, eg of one healthcheck"""
+        stat = read_stat()
+        now = monotonic()
+
+        with self.lock:
+            previous = self.stats.get(id, (None, {}))[1]
+            self.stats[id] = now, stat
+
+            # forget healthchecks gone for a day, eg removed from the config
+            for old in [i for i, (t, _) in self.stats.items() if now - t > 86400]:
+                del self.stats[old]
+
+        cores = sorted(
+            (name for name in stat if name != "cpu"), key=lambda n: int(n[3:])
+        )
+
+        return {
+            "cpu": cpu_usage(previous.get("cpu"), stat["cpu"]),
+            "cores": [cpu_usage(previous.get(n), stat[n]) for n in cores],
+        }
+
+
+sampler = HostSampler(tick=float(getenv("DSPORTAL_HOST_TICK", 5)))
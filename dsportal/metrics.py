@@ -0,0 +1,253 @@
+"""
+Metrics of the server's own behaviour in the Prometheus text format, served at
+/metrics. Counters and histograms are updated where events happen; per
+healthcheck lines are rendered when the result changes, so a scrape joins
+pre-rendered lines rather than formatting every series.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds, for healthchecks, some of which take minutes
+CHECK_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# seconds, for dispatch to result, fine enough to size a server by
+RESULT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2)
+RESULT_BUCKETS += (0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5, 7.5, 10, 30, 60, 120, 300)
+
+# value of dsportal_healthcheck_healthy, as in dsportal.history
+HEALTHY_CODES = {True: 1, False: 0, None: -1}
+HEALTH_NAMES = {True: "healthy", False: "unhealthy", None: "unknown"}
+
+
+def escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def labels(**kwargs):
+    if not kwargs:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in kwargs.items())
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        "Upper bound of the bucket containing quantile q, None if no samples"
+        if not self.count:
+            return None
+
+        cumulative = 0
+        for le, n in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += n
+            if cumulative >= q * self.count:
+                return le
+
+    def lines(self, name, **kwargs):
+        label_str = ",".join('%s="%s"' % (k, escape(v)) for k, v in kwargs.items())
+        sep = "," if label_str else ""
+
+        cumulative = 0
+        for le, n in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += n
+            yield '%s_bucket{%s%sle="%s"} %s' % (name, label_str, sep, le, cumulative)
+
+        yield "%s_sum%s %s" % (name, labels(**kwargs), self.sum)
+        yield "%s_count%s %s" % (name, labels(**kwargs), self.count)
+
+
+class Metrics(object):
+    "Server metrics, kept by the Index"
+
+    def __init__(self):
+        # worker -> count
+        self.dispatched = defaultdict(int)
+        self.results = defaultdict(int)
+        # reason -> count of checks that could not be sent to a remote worker
+        self.undelivered = defaultdict(int)
+        # worker -> seconds from dispatch to result arriving on the loop
+        self.result_seconds = defaultdict(lambda: Histogram(RESULT_BUCKETS))
+        self.timeouts = 0
+        self.render_seconds = Histogram()
+
+        # healthcheck id -> pre-rendered dsportal_healthcheck_healthy line
+        self.healthcheck_lines = dict()
+        # (generation, encoded healthcheck lines) of the last render
+        self.cache = None
+
+    def update_healthcheck(self, h):
+        "Call when the result of h changes"
+        self.healthcheck_lines[h.id] = "dsportal_healthcheck_healthy%s %s" % (
+            labels(
+                entity=h.entity.name,
+                healthcheck=h.label,
+                cls=h.cls,
+                worker=h.worker or "local",
+                key=h.key,
+            ),
+            HEALTHY_CODES[h.result["healthy"]],
+        )
+
+    def render(self, index):
+        "Exposition text of everything known to index, encoded"
+        lines = list()
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for label_kwargs, value in samples:
+                lines.append("%s%s %s" % (name, labels(**label_kwargs), value))
+
+        metric(
+            "dsportal_dispatched_total",
+            "counter",
+            "Healthchecks dispatched to workers",
+            [({"worker": w}, n) for w, n in self.dispatched.items()],
+        )
+        metric(
+            "dsportal_results_total",
+            "counter",
+            "Healthcheck results received",
+            [({"worker": w}, n) for w, n in self.results.items()],
+        )
+        metric(
+            "dsportal_undelivered_total",
+            "counter",
+            "Healthchecks not sent to an offline or congested worker",
+            [({"reason": r}, n) for r, n in self.undelivered.items()],
+        )
+        metric(
+            "dsportal_timeouts_total",
+            "counter",
+            "Healthchecks invalidated for not reporting in time",
+            [({}, self.timeouts)],
+        )
+        metric(
+            "dsportal_worker_websockets",
+            "gauge",
+            "Connected remote workers",
+            [({}, len(index.worker_websockets))],
+        )
+        metric(
+            "dsportal_client_websockets",
+            "gauge",
+            "Connected browsers",
+            [({}, len(index.client_websockets))],
+        )
+
+        stats = index.scheduler.stats()
+        metric(
+            "dsportal_scheduled",
+            "gauge",
+            "Healthchecks scheduled",
+            [({}, stats["scheduled"])],
+        )
+        metric(
+            "dsportal_scheduler_overdue",
+            "gauge",
+            "Healthchecks past their due time",
+            [({}, stats["overdue"])],
+        )
+        metric(
+            "dsportal_scheduler_lag_seconds",
+            "gauge",
+            "How late the last batch of healthchecks was dispatched",
+            [({}, stats["lag"])],
+        )
+
+        stats = index.local_worker.stats()
+        for key, help in (
+            ("threads", "Threads of the local worker"),
+            ("busy_threads", "Threads of the local worker running a check"),
+            ("queued", "Checks waiting for a local worker thread"),
+            ("queue_wait", "Moving average of seconds checks wait for a thread"),
+            ("async_checks", "Coroutine checks in flight on the local worker"),
+        ):
+            name = "dsportal_local_worker_%s" % key
+            if key == "queue_wait":
+                name += "_seconds"
+            metric(name, "gauge", help, [({}, stats[key])])
+
+        metric(
+            "dsportal_local_worker_dropped_total",
+            "counter",
+            "Checks the local worker was too busy to run",
+            [({"cls": cls}, n) for cls, n in stats["drops"].items()],
+        )
+
+        for key, kind, help in (
+            ("queued", "gauge", "Alerts waiting to be delivered"),
+            ("sent", "counter", "Alerts delivered"),
+            ("failed", "counter", "Alerts given up on after retries"),
+            ("dropped", "counter", "Alerts dropped as the queue was full"),
+        ):
+            name = "dsportal_alerts_%s" % key
+            if kind == "counter":
+                name += "_total"
+            metric(
+                name,
+                kind,
+                help,
+                [({"alerter": str(a)}, a.stats()[key]) for a in index.alerters],
+            )
+
+        name = "dsportal_result_seconds"
+        lines.append("# HELP %s Time from dispatch to result, by worker" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for worker, histogram in list(self.result_seconds.items()):
+            lines.extend(histogram.lines(name, worker=worker))
+
+        name = "dsportal_alerts_delivery_seconds"
+        lines.append("# HELP %s Time from alert to delivery, including retries" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for a in index.alerters:
+            lines.extend(a.latency.lines(name, alerter=str(a)))
+
+        for name, i, help in (
+            ("queue_wait", 0, "Time checks waited to run on the local worker"),
+            ("execution", 1, "Time checks took to run on the local worker"),
+        ):
+            name = "dsportal_check_%s_seconds" % name
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for cls, timings in list(index.local_worker.timings.items()):
+                lines.extend(timings[i].lines(name, cls=cls))
+
+        lines.append("# HELP dsportal_render_seconds Time to render a tab")
+        lines.append("# TYPE dsportal_render_seconds histogram")
+        lines.extend(self.render_seconds.lines("dsportal_render_seconds"))
+
+        metric(
+            "dsportal_healthchecks",
+            "gauge",
+            "Healthchecks by health",
+            [
+                ({"health": HEALTH_NAMES[health]}, len(group))
+                for health, group in index.healthchecks_by_health.items()
+            ],
+        )
+
+        if not self.cache or self.cache[0] != index.generation:
+            self.cache = index.generation, "\n".join(
+                [
+                    "# HELP dsportal_healthcheck_healthy 1 if healthy, 0 if "
+                    "unhealthy, -1 if unknown",
+                    "# TYPE dsportal_healthcheck_healthy gauge",
+                ]
+                + list(self.healthcheck_lines.values())
+                + [""]
+            ).encode()
+
+        return ("\n".join(lines) + "\n").encode() + self.cache[1]
@@ -0,0 +1,88 @@
+"""
+Pool of pre-started child processes to run healthchecks with a hard deadline.
+A child that overruns is killed and replaced, so a hung check (whois, boto3...)
+cannot hold a worker forever, and CPU-heavy checks do not contend on the GIL.
+"""
+import multiprocessing
+import asyncio
+import aiohttp
+import queue
+import logging
+from dsportal.util import extract_classes
+from dsportal.util import human_seconds
+
+log = logging.getLogger(__name__)
+
+
+def _child(conn):
+    "Runs checks sent over conn until the parent goes away"
+    from dsportal.base import HealthCheck
+
+    hclasses = extract_classes("dsportal.healthchecks", HealthCheck)
+
+    while True:
+        try:
+            cls, kwargs = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        hclass = hclasses[cls]
+
+        if hclass.is_async():
+            # a loop per check, closed after, so none leak in a long-lived child
+            result = asyncio.run(_run_async(hclass, kwargs))
+        else:
+            result = hclass.run_check(**kwargs)
+
+        conn.send(result)
+
+
+async def _run_async(hclass, kwargs):
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        return await hclass.run_check_async(session, **kwargs)
+
+
+class ProcessPool(object):
+    def __init__(self, size=2):
+        self.size = size
+        # children are spawned rather than forked as the parent is threaded
+        self.context = multiprocessing.get_context("spawn")
+        # (process, connection) of children waiting for a check
+        self.idle = queue.Queue()
+
+    def start(self):
+        for x in range(self.size):
+            self.idle.put(self._spawn())
+
+    def _spawn(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_child, args=(child_conn,))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+
+        return process, conn
+
+    def run_check(self, cls, kwargs, deadline):
+        """Run check in a child, killing it if no result arrives within
+        deadline seconds. Blocks, so call from a worker thread."""
+        process, conn = self.idle.get()
+
+        try:
+            conn.send((cls, kwargs))
+            if conn.poll(deadline):
+                result = conn.recv()
+                self.idle.put((process, conn))
+                return result
+
+            reason = "Check timed out after %s" % human_seconds(deadline)
+        except (EOFError, OSError):
+            reason = "Check process died"
+
+        log.warn("%s: %s %s. Replacing process.", reason, cls, kwargs)
+        process.kill()
+        process.join()
+        conn.close()
+        self.idle.put(self._spawn())
+
+        return {"healthy": None, "reason": reason, "value": ""}
@@ -0,0 +1,319 @@
+"""
+Binary protocol between server and remote workers, modelled on the messages
+in dsportal.proto. Every websocket frame is a batch of records of one type:
+
+    frame:      version (u8), type (u8), count (u32), records...
+    DEFINE:     number (u32), priority (u8), cls (str), kwargs (str, JSON)
+    DISPATCH:   number (u32)
+    RESULT:     number (u32), status (u8), flags (u8), value, reason (str),
+                [bar_percent (f32), bar_min (str), bar_max (str)],
+                [bytes (i64)], [extra (str, JSON)]
+
+Strings are UTF-8 prefixed with a u32 length. Healthchecks are defined once
+per connection and referenced by number afterwards. Workers that connect
+without the PROTOCOL_HEADER speak the original JSON protocol.
+"""
+import asyncio
+import json
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+VERSION = 3
+PROTOCOL_HEADER = "X-Dsportal-Protocol"
+
+DEFINE = 1
+DISPATCH = 2
+RESULT = 3
+
+# Status enum of dsportal.proto
+UNKNOWN = 0
+OK = 1
+FAILED = 2
+
+STATUS_BY_HEALTHY = {None: UNKNOWN, True: OK, False: FAILED}
+HEALTHY_BY_STATUS = {UNKNOWN: None, OK: True, FAILED: False}
+
+# RESULT flags
+VALUE_INT = 1
+VALUE_FLOAT = 2
+BAR = 4
+BYTES = 8
+EXTRA = 16
+
+HEADER = struct.Struct(">BBI")
+NUMBER = struct.Struct(">I")
+DEFINE_HEAD = struct.Struct(">IB")
+RESULT_HEAD = struct.Struct(">IBB")
+STRLEN = struct.Struct(">I")
+INT = struct.Struct(">q")
+FLOAT = struct.Struct(">d")
+PERCENT = struct.Struct(">f")
+
+# keys with a dedicated encoding in RESULT
+RESULT_KEYS = {
+    "healthy",
+    "value",
+    "reason",
+    "bar_percent",
+    "bar_min",
+    "bar_max",
+    "bytes",
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _pack_str(parts, string):
+    b = str(string).encode()
+    parts.append(STRLEN.pack(len(b)))
+    parts.append(b)
+
+
+def _unpack_str(buf, offset):
+    (length,) = STRLEN.unpack_from(buf, offset)
+    offset += STRLEN.size
+    return bytes(buf[offset : offset + length]).decode(), offset + length
+
+
+def encode_defines(definitions):
+    "definitions: [(number, priority, cls, kwargs)]"
+    parts = [HEADER.pack(VERSION, DEFINE, len(definitions))]
+    for number, priority, cls, kwargs in definitions:
+        parts.append(DEFINE_HEAD.pack(number, priority))
+        _pack_str(parts, cls)
+        _pack_str(parts, json.dumps(kwargs))
+
+    return b"".join(parts)
+
+
+def encode_dispatches(numbers):
+    return HEADER.pack(VERSION, DISPATCH, len(numbers)) + b"".join(
+        NUMBER.pack(n) for n in numbers
+    )
+
+
+def encode_results(results):
+    """results: [(number, result)]. A result that cannot be encoded is sent
+    as unknown, so it does not take the rest of the batch with it."""
+    parts = [HEADER.pack(VERSION, RESULT, len(results))]
+
+    for number, result in results:
+        try:
+            record = list()
+            _encode_result(record, number, result)
+        except (struct.error, TypeError, ValueError, KeyError) as e:
+            log.error("Cannot encode result of healthcheck %s: %s", number, e)
+            record = list()
+            _encode_result(
+                record,
+                number,
+                {"healthy": None, "reason": "Result could not be encoded: %s" % e},
+            )
+
+        parts.extend(record)
+
+    return b"".join(parts)
+
+
+def _encode_result(parts, number, result):
+    "Append the encoded record to parts"
+    value = result.get("value", "")
+    extra = {k: v for k, v in result.items() if k not in RESULT_KEYS}
+
+    flags = 0
+    if isinstance(value, int) and not isinstance(value, bool):
+        flags |= VALUE_INT
+    elif isinstance(value, float):
+        flags |= VALUE_FLOAT
+    if "bar_percent" in result:
+        flags |= BAR
+    if "bytes" in result:
+        flags |= BYTES
+    if extra:
+        flags |= EXTRA
+
+    parts.append(RESULT_HEAD.pack(number, STATUS_BY_HEALTHY[result["healthy"]], flags))
+
+    if flags & VALUE_INT:
+        parts.append(INT.pack(value))
+    elif flags & VALUE_FLOAT:
+        parts.append(FLOAT.pack(value))
+    else:
+        _pack_str(parts, value)
+
+    _pack_str(parts, result.get("reason", ""))
+
+    if flags & BAR:
+        parts.append(PERCENT.pack(result["bar_percent"]))
+        _pack_str(parts, result["bar_min"])
+        _pack_str(parts, result["bar_max"])
+
+    if flags & BYTES:
+        parts.append(INT.pack(result["bytes"]))
+
+    if flags & EXTRA:
+        _pack_str(parts, json.dumps(extra))
+
+
+def decode(frame):
+    """Decode a frame into (type, records). Records are (number, priority,
+    cls, kwargs) for DEFINE, number for DISPATCH and (number, result) for RESULT."""
+    buf = memoryview(frame)
+
+    try:
+        version, kind, count = HEADER.unpack_from(buf, 0)
+    except struct.error:
+        raise ProtocolError("Truncated frame")
+
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version %s" % version)
+
+    offset = HEADER.size
+    records = list()
+
+    try:
+        if kind == DEFINE:
+            for x in range(count):
+                number, priority = DEFINE_HEAD.unpack_from(buf, offset)
+                cls, offset = _unpack_str(buf, offset + DEFINE_HEAD.size)
+                kwargs, offset = _unpack_str(buf, offset)
+                records.append((number, priority, cls, json.loads(kwargs)))
+
+        elif kind == DISPATCH:
+            records = [n for (n,) in NUMBER.iter_unpack(buf[offset:])]
+
+        elif kind == RESULT:
+            for x in range(count):
+                number, result, offset = _decode_result(buf, offset)
+                records.append((number, result))
+
+        else:
+            raise ProtocolError("Unknown frame type %s" % kind)
+    except struct.error:
+        raise ProtocolError("Truncated frame")
+
+    return kind, records
+
+
+def _decode_result(buf, offset):
+    number, status, flags = RESULT_HEAD.unpack_from(buf, offset)
+    offset += RESULT_HEAD.size
+
+    result = {"healthy": HEALTHY_BY_STATUS[status]}
+
+    if flags & VALUE_INT:
+        (result["value"],) = INT.unpack_from(buf, offset)
+        offset += INT.size
+    elif flags & VALUE_FLOAT:
+        (result["value"],) = FLOAT.unpack_from(buf, offset)
+        offset += FLOAT.size
+    else:
+        result["value"], offset = _unpack_str(buf, offset)
+
+    result["reason"], offset = _unpack_str(buf, offset)
+
+    if flags & BAR:
+        (bar_percent,) = PERCENT.unpack_from(buf, offset)
+        result["bar_percent"] = round(bar_percent, 3)
+        result["bar_min"], offset = _unpack_str(buf, offset + PERCENT.size)
+        result["bar_max"], offset = _unpack_str(buf, offset)
+
+    if flags & BYTES:
+        (result["bytes"],) = INT.unpack_from(buf, offset)
+        offset += INT.size
+
+    if flags & EXTRA:
+        extra, offset = _unpack_str(buf, offset)
+        result.update(json.loads(extra))
+
+    return number, result, offset
+
+
+class Batcher(object):
+    """Collects items and passes them in batches to the coroutine function
+    send(items). A batch is sent `delay` seconds after the first item is added,
+    in chunks of at most `size` items. Only one send is in flight at a time;
+    items added meanwhile are sent when it completes. Over max_pending items, add()
+    refuses further items so a slow connection cannot buffer unboundedly."""
+
+    def __init__(self, send, size=1000, delay=0.01, max_pending=10000):
+        self.send = send
+        self.size = size
+        self.delay = delay
+        self.max_pending = max_pending
+        self.items = list()
+        self.task = None
+
+    def add(self, item):
+        "Returns False if the item was refused"
+        if len(self.items) >= self.max_pending:
+            return False
+
+        self.items.append(item)
+
+        if not self.task or self.task.done():
+            self.task = asyncio.ensure_future(self._flush())
+
+        return True
+
+    async def add_wait(self, item):
+        "Wait until the item is accepted"
+        while not self.add(item):
+            await self.task
+
+    async def _flush(self):
+        await asyncio.sleep(self.delay)
+
+        try:
+            while self.items:
+                items = self.items[: self.size]
+                self.items = self.items[self.size :]
+                await self.send(items)
+        except Exception:
+            log.exception("Batch send failed, dropping %s items", len(self.items))
+            self.items = list()
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+
+
+class WorkerLink(object):
+    """Server side of a connection to a remote worker. Healthchecks are
+    dispatched in batches; binary links define each healthcheck once."""
+
+    def __init__(self, ws, binary=True):
+        self.ws = ws
+        self.binary = binary
+        # healthcheck numbers defined on this connection
+        self.defined = set()
+        self.batcher = Batcher(self._send)
+
+    def dispatch(self, h):
+        "Returns False if the link is congested"
+        return self.batcher.add(h)
+
+    async def _send(self, healthchecks):
+        if not self.binary:
+            for h in healthchecks:
+                await self.ws.send_json((h.cls, h.id, h.check_kwargs))
+            return
+
+        new = [h for h in healthchecks if h.number not in self.defined]
+
+        if new:
+            await self.ws.send_bytes(
+                encode_defines(
+                    [(h.number, h.priority, h.cls, h.check_kwargs) for h in new]
+                )
+            )
+            self.defined.update(h.number for h in new)
+
+        await self.ws.send_bytes(encode_dispatches([h.number for h in healthchecks]))
+
+    def close(self):
+        self.batcher.close()
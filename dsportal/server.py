@@ -10,15 +10,27 @@ from dsportal.config import USER_CONFIG
 from dsportal.config import ASSET_DIR
 from dsportal.config import STATIC_DIR
 from dsportal.config import TEMPLATES_DIR
+from dsportal.config import CONFIG_DIR
 import asyncio
 import aiohttp
 import sys
 import jinja2
 import aiohttp_jinja2
 import logging
+import gzip
 from dsportal.util import setup_logging
 from dsportal.util import human_seconds
 from dsportal import base
+from dsportal import protocol
+from dsportal.history import History
+from os import path
+from time import time
+from time import monotonic
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 setup_logging()
 log = logging.getLogger(__name__)
@@ -42,28 +54,112 @@ async def worker_websocket(request):
             text="Worker %s already connected" % worker, status=403
         )
 
+    # workers without the header speak JSON; others must match exactly
+    version = request.headers.get(protocol.PROTOCOL_HEADER)
+    if version is not None and version != str(protocol.VERSION):
+        return aiohttp.web.Response(
+            text="Unsupported protocol version %s, server supports version %s"
+            % (version, protocol.VERSION),
+            status=403,
+        )
+
+    binary = version is not None
+
     ws = aiohttp.web.WebSocketResponse()
     await ws.prepare(request)
 
+    link = protocol.WorkerLink(ws, binary=binary)
+
     try:
-        index.worker_websockets[worker] = ws
+        index.worker_websockets[worker] = link
 
-        log.info("worker %s connected", worker)
+        log.info("worker %s connected (%s)", worker, "binary" if binary else "JSON")
 
         async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                try:
+                    kind, results = protocol.decode(msg.data)
+                except protocol.ProtocolError as e:
+                    log.error("Worker %s protocol error: %s", worker, e)
+                    break
+
+                if kind != protocol.RESULT:
+                    continue
+
+                for number, result in results:
+                    try:
+                        h = index.healthchecks[number]
+                    except IndexError:
+                        log.warn("Worker %s sent unknown healthcheck", worker)
+                        continue
+                    index.receive_result(h.id, result)
+
+            elif msg.type == aiohttp.WSMsgType.TEXT:
                 id, result = msg.json()
-                index.dispatch_result(id, result)
+                index.receive_result(id, result)
     finally:
+        link.close()
         del index.worker_websockets[worker]
 
     return ws
 
 
-@aiohttp_jinja2.template("tab.html")
-async def tab_handler(request):
+async def client_websocket(request):
+    "Pushes result deltas to browsers. See Index.push_deltas()"
+    index = request.app["index"]
+
+    ws = aiohttp.web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    # the page may be older than the last delta, so start from current state
+    tab = request.query.get("tab")
+    state = index.client_state(tab)
+    await ws.send_json(state)
+
+    try:
+        index.add_client(ws, tab, state["generation"])
+
+        # clients do not send anything; wait for disconnection
+        async for msg in ws:
+            pass
+    finally:
+        index.remove_client(ws)
+
+    return ws
+
+
+async def history_handler(request):
+    """History of a healthcheck as JSON. Query parameters `start` and `end`
+    are unix times, `resolution` is one of raw, 1m, 1h, 1d. By default the
+    last day is returned at the finest resolution available."""
+    index = request.app["index"]
+
+    if not index.history:
+        return aiohttp.web.Response(text="History is not enabled", status=404)
+
+    try:
+        h = index.healthcheck_by_id[request.match_info["id"]]
+    except KeyError:
+        return aiohttp.web.Response(text="Unknown healthcheck", status=404)
+
+    try:
+        end = float(request.query.get("end", time()))
+        start = float(request.query.get("start", end - 86400))
+        resolution = request.query.get("resolution")
+        # waits for History.write to release the lock, so off the event loop
+        resolution, samples = await asyncio.get_event_loop().run_in_executor(
+            None, index.history.query, h.key, start, end, resolution
+        )
+    except ValueError as e:
+        return aiohttp.web.Response(text=str(e), status=400)
+
+    return aiohttp.web.json_response(
+        {"id": h.id, "key": h.key, "resolution": resolution, "samples": samples}
+    )
+
+
+def render_tab(request, tab):
     index = request.app["index"]
-    tab = request.match_info.get("tab", index.entities[0].tab)
 
     healthchecks = []
     entities = []
@@ -76,30 +172,124 @@ async def tab_handler(request):
             + index.unknown_healthchecks
             + index.healthy_healthchecks
         )
-    else:
+
+    num_healthy = len(index.healthchecks_by_health[True])
+    num_unhealthy = len(index.healthchecks_by_health[False])
+    num_unknown = len(index.healthchecks_by_health[None])
+
+    return aiohttp_jinja2.render_string(
+        "tab.html",
+        request,
+        {
+            "tab": tab,
+            "tabs": list(index.entities_by_tab.keys()),
+            "entities": entities,
+            "name": USER_CONFIG.get("name"),
+            "extra_head": USER_CONFIG.get("extra_head"),
+            "header": USER_CONFIG.get("header", ""),
+            "footer": USER_CONFIG.get("footer", ""),
+            "num_healthy": num_healthy,
+            "num_unhealthy": num_unhealthy,
+            "num_unknown": num_unknown,
+            "percent_healthy": round(num_healthy * 100 / len(index.healthchecks), 3),
+            "percent_unhealthy": round(
+                num_unhealthy * 100 / len(index.healthchecks), 3
+            ),
+            "healthchecks": healthchecks,
+            "instance_id": index.instance_id,
+        },
+    )
+
+
+def accepted_encoding(request):
+    accept = request.headers.get("Accept-Encoding", "")
+
+    if brotli and "br" in accept:
+        return "br"
+
+    if "gzip" in accept:
+        return "gzip"
+
+    return "identity"
+
+
+def compress(encoding, body):
+    "Fast settings, as pages are rendered again after most results"
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+
+    return gzip.compress(body, 5)
+
+
+async def tab_handler(request):
+    """Serves tab pages rendered once per change to the tab, compressed off
+    the event loop in each encoding when first requested. Clients revalidate
+    with If-None-Match."""
+    index = request.app["index"]
+    tab = request.match_info.get("tab", index.entities[0].tab)
+
+    if tab not in index.entities_by_tab and tab != "healthchecks":
         # TODO replace with exception and special 403 middleware
         return aiohttp.web.Response(text="Unregistered tab", status=403)
 
-    return {
-        "tab": tab,
-        "tabs": list(index.entities_by_tab.keys()),
-        "entities": entities,
-        "name": USER_CONFIG.get("name"),
-        "extra_head": USER_CONFIG.get("extra_head"),
-        "header": USER_CONFIG.get("header", ""),
-        "footer": USER_CONFIG.get("footer", ""),
-        "num_healthy": len(index.healthy_healthchecks),
-        "num_unhealthy": len(index.unhealthy_healthchecks),
-        "num_unknown": len(index.unknown_healthchecks),
-        "percent_healthy": round(
-            len(index.healthy_healthchecks) * 100 / len(index.healthchecks), 3
-        ),
-        "percent_unhealthy": round(
-            len(index.unhealthy_healthchecks) * 100 / len(index.healthchecks), 3
-        ),
-        "healthchecks": healthchecks,
+    cache = request.app["render_cache"]
+    generation = index.tab_generation(tab)
+
+    if tab not in cache or cache[tab]["generation"] != generation:
+        start = monotonic()
+        html = render_tab(request, tab).encode()
+        index.metrics.render_seconds.observe(monotonic() - start)
+        cache[tab] = {"generation": generation, "bodies": {"identity": html}}
+
+    bodies = cache[tab]["bodies"]
+    encoding = accepted_encoding(request)
+    etag = '"%s-%s-%s"' % (index.instance_id, generation, encoding)
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
     }
 
+    if etag in request.headers.get("If-None-Match", ""):
+        return aiohttp.web.Response(status=304, headers=headers)
+
+    if encoding not in bodies:
+        bodies[encoding] = await asyncio.get_event_loop().run_in_executor(
+            None, compress, encoding, bodies["identity"]
+        )
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    return aiohttp.web.Response(
+        body=bodies[encoding],
+        content_type="text/html",
+        charset="utf-8",
+        headers=headers,
+    )
+
+
+async def metrics_handler(request):
+    "Prometheus metrics"
+    index = request.app["index"]
+    body = index.metrics.render(index)
+    headers = {}
+
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        # tens of MB with many healthchecks, so compress off the event loop
+        body = await asyncio.get_event_loop().run_in_executor(
+            None, gzip.compress, body, 1
+        )
+        headers["Content-Encoding"] = "gzip"
+
+    return aiohttp.web.Response(
+        body=body,
+        content_type="text/plain",
+        charset="utf-8",
+        headers=headers,
+    )
+
 
 def main():
     if len(sys.argv) < 2:
@@ -110,7 +300,9 @@ def main():
     app.router.add_static("/static", STATIC_DIR)  # TODO nginx static overlay
     app.router.add_static("/assets", ASSET_DIR)
     app.router.add_get("/worker-websocket", worker_websocket)
-    # app.router.add_get('/client-websocket',sso)
+    app.router.add_get("/client-websocket", client_websocket)
+    app.router.add_get("/history/{id}", history_handler)
+    app.router.add_get("/metrics", metrics_handler)
     app.router.add_get("/", tab_handler)
     app.router.add_get("/{tab}", tab_handler)
 
@@ -121,18 +313,47 @@ def main():
         filters={"human_seconds": human_seconds},
     )
 
-    index = app["index"] = base.Index(USER_CONFIG["name"])
+    index = app["index"] = base.Index(
+        USER_CONFIG["name"], worker_config=USER_CONFIG.get("local_worker")
+    )
+    index.client_update_interval = USER_CONFIG.get("client_update_interval", 0.5)
+    app["render_cache"] = dict()
 
     for e in USER_CONFIG["entities"]:
         index.instantiate_entity(**e)
 
+    if USER_CONFIG.get("history", True):
+        index.history = History(
+            USER_CONFIG.get("history_dir", path.join(CONFIG_DIR, "history")),
+            length=USER_CONFIG.get("history_length", 1440),
+        )
+        index.history.register([h.key for h in index.healthchecks])
+
     if "alerters" in USER_CONFIG:
         for a in USER_CONFIG["alerters"]:
             index.instantiate_alerter(**a)
 
+    snapshot_file = USER_CONFIG.get(
+        "snapshot_file", path.join(CONFIG_DIR, "snapshot.json.gz")
+    )
+
+    index.load_snapshot(snapshot_file)
+
     loop = asyncio.get_event_loop()
     index.register_tasks(loop)
 
+    loop.create_task(
+        index.save_snapshots(snapshot_file, USER_CONFIG.get("snapshot_interval", 60))
+    )
+
+    async def on_shutdown(app):
+        index.save_snapshot(snapshot_file)
+
+        if index.history:
+            index.history.write()
+
+    app.on_shutdown.append(on_shutdown)
+
     aiohttp.web.run_app(
         app,
         port=USER_CONFIG.get("port", 8080),
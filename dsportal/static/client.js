@@ -0,0 +1,181 @@
+// Applies result deltas pushed by the server over /client-websocket.
+// On (re)connect the server sends the current state of the tab, so the page
+// is patched in place however old it is. Results are set as text, never HTML.
+(function () {
+    var instance = document.body.getAttribute("data-instance");
+    var tab = document.body.getAttribute("data-tab");
+
+    if (!instance || !window.WebSocket) {
+        return;
+    }
+
+    function health_class(healthy) {
+        return healthy ? "good" : healthy === false ? "bad" : "";
+    }
+
+    function text(s) {
+        return s === undefined || s === null ? "" : String(s);
+    }
+
+    function cell(row, cls, content) {
+        var td = document.createElement("td");
+        td.className = cls;
+        td.textContent = text(content);
+        row.appendChild(td);
+        return td;
+    }
+
+    // entities/Host.html: cells after the label depend on whether there is a bar
+    function patch_metric(row, result) {
+        var key = row.querySelector(".key");
+
+        while (key.nextSibling) {
+            row.removeChild(key.nextSibling);
+        }
+
+        if (result.bar_percent !== undefined) {
+            cell(row, "value", result.value);
+            cell(row, "min", result.bar_min);
+
+            var meter = document.createElement("div");
+            var bar = document.createElement("div");
+            meter.className = "meter";
+            bar.className = "bar";
+            bar.style.width = result.bar_percent + "%";
+            meter.appendChild(bar);
+            cell(row, "", "").appendChild(meter);
+
+            cell(row, "max", result.bar_max);
+        } else {
+            var value = "value" in result ? result.value : "reason" in result ? result.reason : "-";
+            cell(row, "value", value).colSpan = 4;
+        }
+    }
+
+    // HealthChecks.html
+    function patch_check(row, state) {
+        var result = state.result;
+        var status = row.querySelector(".status");
+
+        row.querySelector(".interval").textContent = state.interval;
+        row.querySelector(".value").textContent = text(result.value);
+        row.querySelector(".reason").textContent = text(result.reason);
+
+        status.textContent = "";
+        if (result.healthy === null) {
+            status.textContent = "?";
+        } else {
+            var span = document.createElement("span");
+            span.style.color = result.healthy ? "#00dd00" : "#dd0000";
+            span.textContent = result.healthy ? "OK" : "FAILED";
+            status.appendChild(span);
+        }
+    }
+
+    // entities/WebApp.html list of failed checks
+    function patch_failed(li, result) {
+        li.hidden = result.healthy !== false;
+        li.title = li.getAttribute("data-doc") + ". Reason: " + text(result.reason);
+    }
+
+    function update_healthcheck(id, state) {
+        var elements = document.querySelectorAll('[data-healthcheck="' + id + '"]');
+
+        for (var i = 0; i < elements.length; i++) {
+            var el = elements[i];
+
+            if (el.tagName === "LI") {
+                patch_failed(el, state.result);
+                continue;
+            }
+
+            el.classList.toggle("bad", state.result.healthy === false);
+
+            if (el.classList.contains("metric")) {
+                patch_metric(el, state.result);
+            } else if (el.classList.contains("check")) {
+                patch_check(el, state);
+            }
+        }
+    }
+
+    function update_entity(id, healthy) {
+        var box = document.getElementById(id);
+
+        if (box) {
+            box.classList.remove("good", "bad");
+            if (health_class(healthy)) {
+                box.classList.add(health_class(healthy));
+            }
+        }
+    }
+
+    function update_count(cls, n) {
+        var h2 = document.querySelector("." + cls);
+        if (h2) {
+            h2.textContent = n;
+            h2.parentNode.hidden = !n;
+        }
+    }
+
+    function update_hud(frame) {
+        var total = frame.num_healthy + frame.num_unknown + frame.num_unhealthy;
+        var percent = document.querySelector(".hud-percent");
+        var healthy = document.querySelector(".hud-bar-healthy");
+        var unhealthy = document.querySelector(".hud-bar-unhealthy");
+        var all = document.querySelector(".all-checks");
+        var problems = frame.num_unknown + frame.num_unhealthy > 0;
+
+        if (percent) {
+            percent.textContent = Math.round(frame.num_healthy * 100 / total);
+        }
+        if (healthy) {
+            healthy.style.width = frame.num_healthy * 100 / total + "%";
+        }
+        if (unhealthy) {
+            unhealthy.style.width = frame.num_unhealthy * 100 / total + "%";
+        }
+        if (all) {
+            all.classList.toggle("tab-warning", problems);
+            all.title = problems ? "Problems detected" : "";
+        }
+
+        update_count("number-healthy", frame.num_healthy);
+        update_count("number-unknown", frame.num_unknown);
+        update_count("number-unhealthy", frame.num_unhealthy);
+    }
+
+    function connect() {
+        var scheme = location.protocol === "https:" ? "wss://" : "ws://";
+        var ws = new WebSocket(
+            scheme + location.host + "/client-websocket?tab=" + encodeURIComponent(tab)
+        );
+
+        ws.onmessage = function (event) {
+            var frame = JSON.parse(event.data);
+
+            // server restarted: healthcheck ids have changed
+            if (frame.instance && frame.instance !== instance) {
+                location.reload();
+                return;
+            }
+
+            for (var id in frame.healthchecks) {
+                update_healthcheck(id, frame.healthchecks[id]);
+            }
+
+            for (var id in frame.entities) {
+                update_entity(id, frame.entities[id]);
+            }
+
+            update_hud(frame);
+        };
+
+        // evicted or server restarted: reconnecting resends the state
+        ws.onclose = function () {
+            setTimeout(connect, 10000);
+        };
+    }
+
+    connect();
+})();
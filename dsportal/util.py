@@ -1,14 +1,22 @@
 import logging
 import colorlog
 import queue
+import asyncio
+from heapq import heappush, heappop, heapify
+from itertools import count
 from time import monotonic, time
-from os import path
+from os import stat
+from threading import Lock
+from threading import Condition
 import importlib
 import inspect
+import json
 import re
 from collections import OrderedDict
 from os import getenv
 
+log = logging.getLogger(__name__)
+
 APCUPSD_CONF_FILE = "/etc/apcupsd/apcupsd.conf"
 APCUPSD_STATFILE = None
 APCUPSD_STATTIME = 60
@@ -33,31 +41,88 @@ except FileNotFoundError:
     pass
 
 
-def get_ups_data():
-    "Get UPS stats from apcupsd via STATFILE"
+# parsed STATFILE shared by all UPS checks in this process, keyed on
+# (inode, mtime, size) so it is parsed at most once per rewrite by apcupsd
+_ups_cache = {"key": None, "data": None, "status": None}
+_ups_lock = Lock()
+
+UPS_LINE = re.compile(r"(\w+)\s*:\s*(.*)")
+UPS_VALUE = re.compile(r"(\d|\w)+")
+
 
+def _read_ups_statfile():
     if not APCUPSD_STATFILE:
         raise Exception("Could not parse location of STATFILE. Is it configured?")
 
-    mtime = path.getmtime(APCUPSD_STATFILE)
+    st = stat(APCUPSD_STATFILE)
 
-    if time() - mtime > APCUPSD_STATTIME * 4:
+    if time() - st.st_mtime > APCUPSD_STATTIME * 4:
         raise Exception("UPS data isn't being updated")
 
-    info = {}
-    with open(APCUPSD_STATFILE) as f:
-        for line in f:
-            m = re.search("(\w+)\s*:\s*((\d|\w)+)", line)
-            if m:
-                try:
-                    info[m.group(1)] = int(m.group(2))
-                except ValueError:
-                    info[m.group(1)] = str(m.group(2))
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    with _ups_lock:
+        if _ups_cache["key"] != key:
+            data = {}
+            status = {}
+            with open(APCUPSD_STATFILE) as f:
+                for line in f:
+                    m = UPS_LINE.match(line)
+                    if not m:
+                        continue
+
+                    k, v = m.group(1), m.group(2).strip()
+                    status[k] = v
 
-    if info["STATUS"] == "COMMLOST":
+                    m = UPS_VALUE.match(v)
+                    if m:
+                        try:
+                            data[k] = int(m.group(0))
+                        except ValueError:
+                            data[k] = str(m.group(0))
+
+            _ups_cache.update(key=key, data=data, status=status)
+
+        data, status = _ups_cache["data"], _ups_cache["status"]
+
+    if data["STATUS"] == "COMMLOST":
         raise Exception("Could not communicate with UPS")
 
-    return info
+    return data, status
+
+
+def get_ups_data():
+    """Get UPS stats from apcupsd via STATFILE. Values are the first word of
+    each field, converted to int if possible"""
+    return dict(_read_ups_statfile()[0])
+
+
+def get_ups_status():
+    """Get the whole apcupsd status via STATFILE, with full string values, eg
+    {"LINEV": "240.0 Volts", ...}"""
+    return dict(_read_ups_statfile()[1])
+
+
+# boto3 clients are thread safe and expensive to create, so are shared by all
+# checks and alerters in the process
+_boto3_clients = dict()
+_boto3_lock = Lock()
+
+
+def get_boto3_client(service_name, **client_kwargs):
+    "Get a cached boto3 client for the service and kwargs"
+    key = service_name, json.dumps(client_kwargs, sort_keys=True, default=str)
+
+    with _boto3_lock:
+        if key not in _boto3_clients:
+            import boto3
+
+            # the default session is not thread safe, so use one per client
+            _boto3_clients[key] = boto3.session.Session().client(
+                service_name=service_name, **client_kwargs
+            )
+
+        return _boto3_clients[key]
 
 
 def bar_percent(value, _max, _min=0):
@@ -88,47 +153,251 @@ def setup_logging():
     logging.getLogger("botocore").setLevel(logging.CRITICAL)
 
 
-class ItemExpired(Exception):
-    def __init__(self, item, *args, **kwargs):
-        super(ItemExpired, self).__init__(*args, **kwargs)
-        self.item = item
+# Priority enum of dsportal.proto
+NORMAL = 0
+CRITICAL = 1
+SUPPRESSED = 2
+
+PRIORITIES = {"normal": NORMAL, "critical": CRITICAL, "suppressed": SUPPRESSED}
+
+# order of service: critical, normal then suppressed
+PRIORITY_RANK = {CRITICAL: 0, NORMAL: 1, SUPPRESSED: 2}
+
+
+def parse_priority(priority):
+    "Priority from its name or number"
+    if priority in PRIORITY_RANK:
+        return priority
+
+    try:
+        return PRIORITIES[str(priority).lower()]
+    except KeyError:
+        raise ValueError("Priority must be one of %s" % ", ".join(PRIORITIES.keys()))
+
 
+class DeadlineQueue(object):
+    """Thread-safe work queue served by priority, then earliest deadline. An
+    item's deadline is ttl seconds after it was put; items not taken by then
+    are removed in bulk and passed to on_expired(items) instead.
 
-class TTLQueue(queue.Queue):
-    def __init__(self, *args, ttl=5, **kwargs):
-        super(TTLQueue, self).__init__(*args, **kwargs)
+    When full, an item evicts the least urgent queued item if it is more
+    urgent, so critical work is still accepted when the queue is saturated."""
+
+    def __init__(self, maxsize=1000, ttl=5, on_expired=None):
+        self.maxsize = maxsize
         self.ttl = ttl
+        self.on_expired = on_expired or (lambda items: None)
+
+        # entries [rank, deadline, seq, item, put time]
+        self.heap = list()
+        self.counter = count()
+        # earliest deadline in heap
+        self.next_deadline = float("inf")
+
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+
+    def qsize(self):
+        return len(self.heap)
+
+    def put_nowait(self, item, priority=NORMAL, ttl=None):
+        """Returns a list of items evicted to make room, raises queue.Full if
+        item is not more urgent than any queued item"""
+        now = monotonic()
+        deadline = now + (self.ttl if ttl is None else ttl)
+        entry = [PRIORITY_RANK[priority], deadline, next(self.counter), item, now]
+        evicted = list()
+
+        with self.lock:
+            if len(self.heap) >= self.maxsize:
+                evicted = self._expire(now)
+
+            if len(self.heap) >= self.maxsize:
+                worst = max(range(len(self.heap)), key=lambda i: self.heap[i][:3])
+
+                if self.heap[worst][:3] < entry[:3]:
+                    raise queue.Full
+
+                evicted.append(self.heap[worst][3])
+                self.heap[worst] = self.heap[-1]
+                self.heap.pop()
+                heapify(self.heap)
+
+            heappush(self.heap, entry)
+            self.next_deadline = min(self.next_deadline, deadline)
+            self.not_empty.notify()
+
+        if evicted:
+            self.on_expired(evicted)
+
+        return evicted
+
+    def get_wait(self, timeout=None):
+        """Returns (item, seconds item waited in queue). Raises queue.Empty
+        after timeout seconds if given."""
+        end = None if timeout is None else monotonic() + timeout
+        expired = list()
+
+        try:
+            with self.lock:
+                while True:
+                    now = monotonic()
+
+                    if now > self.next_deadline:
+                        expired += self._expire(now)
+
+                    if self.heap:
+                        entry = heappop(self.heap)
+                        return entry[3], now - entry[4]
+
+                    if end is not None and now >= end:
+                        raise queue.Empty
+
+                    self.not_empty.wait(None if end is None else end - now)
+        finally:
+            if expired:
+                self.on_expired(expired)
+
+    def _expire(self, now):
+        "Remove and return items past their deadline. Call with lock held."
+        expired = [e[3] for e in self.heap if e[1] < now]
+
+        if expired:
+            self.heap = [e for e in self.heap if e[1] >= now]
+            heapify(self.heap)
+
+        self.next_deadline = min((e[1] for e in self.heap), default=float("inf"))
+
+        return expired
+
+
+class Scheduler(object):
+    """Keeps the next due time of every scheduled item in a min-heap so that a
+    single task can run any number of periodic items. Items must have `id` and
+    `interval` (seconds) attributes. Items can be added or removed at any time.
+    """
+
+    def __init__(self):
+        self.heap = list()
+        # item id -> live heap entry [due, seq, item]. Removed entries have
+        # their item set to None and are discarded lazily when popped.
+        self.entries = dict()
+        # tie breaker so items themselves are never compared
+        self.counter = count()
+        self.wakeup = None
+
+        # how late the last batch was dispatched, in seconds
+        self.lag = 0
+        self.max_lag = 0
+
+    def add(self, item, delay=0):
+        "Schedule item to be due after delay seconds, replacing any existing schedule"
+        self._push(item, monotonic() + delay)
+
+        # run() may be sleeping until a later due time
+        if self.wakeup and self.heap[0][-1] is item:
+            self.wakeup.set()
+
+    def reschedule(self, item, delay=0):
+        "Change the due time of item, if scheduled"
+        if item.id in self.entries:
+            self.add(item, delay)
+
+    def remove(self, item):
+        entry = self.entries.pop(item.id, None)
+        if entry:
+            entry[-1] = None
+
+    def _push(self, item, due):
+        self.remove(item)
+        entry = [due, next(self.counter), item]
+        self.entries[item.id] = entry
+        heappush(self.heap, entry)
+
+    def _discard_removed(self):
+        while self.heap and self.heap[0][-1] is None:
+            heappop(self.heap)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def next_due(self):
+        "Seconds until the next item is due, negative if overdue. None if empty."
+        self._discard_removed()
+        if not self.heap:
+            return None
+
+        return self.heap[0][0] - monotonic()
+
+    @property
+    def overdue(self):
+        "Number of items past their due time. Visits overdue entries only."
+        now = monotonic()
+        num = 0
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i >= len(self.heap) or self.heap[i][0] > now:
+                continue
+
+            if self.heap[i][-1] is not None:
+                num += 1
 
-    def put_nowait(self, item):
-        expiry = monotonic() + self.ttl
-        super(TTLQueue, self).put((item, expiry), block=False)
+            stack += [2 * i + 1, 2 * i + 2]
 
-    def get_nowait(self):
-        item, expiry = super(TTLQueue, self).get(block=False)
+        return num
 
-        if monotonic() > expiry:
-            self.task_done()
-            raise ItemExpired(item)
+    def stats(self):
+        return {
+            "scheduled": len(self),
+            "next_due": self.next_due,
+            "overdue": self.overdue,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
 
-        return item
+    async def run(self, callback):
+        """Callback(item) for every item as it becomes due, then reschedule it
+        at its interval. Add to event loop as a task."""
+        self.wakeup = asyncio.Event()
 
-    def get_wait(self):
         while True:
-            item, expiry = super(TTLQueue, self).get(block=True)
+            timeout = self.next_due
+
+            if timeout is None or timeout > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-            if monotonic() > expiry:
-                self.task_done()
-                raise ItemExpired(item)
+            now = monotonic()
+            self.lag = now - self.heap[0][0]
+            self.max_lag = max(self.max_lag, self.lag)
 
-            break
+            if self.lag > 1:
+                log.warn("Scheduler is running %.1f seconds late", self.lag)
 
-        return item
+            while self.heap and self.heap[0][0] <= now:
+                due, _, item = heappop(self.heap)
 
-    def put(self, *args, **kwargs):
-        raise NotImplementedError("use put_nowait")
+                if item is None:
+                    continue
 
-    def get(self, *args, **kwargs):
-        raise NotImplementedError("use get_nowait")
+                # keep phase, unless a whole interval was missed in which
+                # case don't burst to catch up
+                due += item.interval
+                if due <= now:
+                    due = now + item.interval
+
+                self._push(item, due)
+
+                try:
+                    callback(item)
+                except Exception:
+                    log.exception("Scheduled callback failed for %s", item)
 
 
 def extract_classes(module_path, Class):
@@ -157,7 +426,10 @@ def validate_result(result, annotated=False):
         )
 
     if "value" in result:
-        if str(result["value"]).endswith("B") and "bytes" not in result:
+        # eg "1.2 GB", as from human_bytes; not an SSL Labs grade of "B"
+        if re.search(r"\d\s*[kKMGTPEZY]?i?B$", str(result["value"])) and (
+            "bytes" not in result
+        ):
             raise ValueError(
                 "If value is in bytes (with magnitude) bytes key must be present"
             )
@@ -190,6 +462,26 @@ def validate_result(result, annotated=False):
             )
 
 
+def parse_ports(ports):
+    """Parse port ranges such as "1-1024,8080" or a list of ints into a sorted
+    list of ports"""
+    if isinstance(ports, int):
+        return [ports]
+
+    if not isinstance(ports, str):
+        return sorted(set(int(p) for p in ports))
+
+    parsed = set()
+    for part in ports.split(","):
+        start, _, end = part.strip().partition("-")
+        try:
+            parsed.update(range(int(start), int(end or start) + 1))
+        except ValueError:
+            raise ValueError("Invalid port range: %s" % part)
+
+    return sorted(parsed)
+
+
 def slug(string):
     return re.sub(r"\W+", "_", string).lower()
 
@@ -1,12 +1,20 @@
 """
 Runs stateless healthchecks scheduled by a dsportal server.
-Usage: %s <server address> <token>
+Usage: %s [--threads MIN[:MAX]] <server address> <token>
+
+Threads for blocking checks are added between MIN (default 4) and MAX
+(default 64) as the queue backs up. Also settable with DSPORTAL_THREADS.
+
+Set DSPORTAL_PROCESS_CHECKS to run checks of the given classes in child
+processes with a hard deadline, eg: DomainExpiryCheck:60,S3BackupChecker:5m
 """
 import sys
 from os import path
+from os import getenv
 import aiohttp
 import asyncio
 from dsportal.base import Worker
+from dsportal import protocol
 import logging
 from dsportal.util import setup_logging
 
@@ -17,7 +25,11 @@ log = logging.getLogger(__name__)
 async def websocket_client(loop, worker, host, key):
     url = path.join(host, "worker-websocket")
     session = aiohttp.ClientSession(
-        loop=loop, headers={"Authorization": "Token " + key}
+        loop=loop,
+        headers={
+            "Authorization": "Token " + key,
+            protocol.PROTOCOL_HEADER: str(protocol.VERSION),
+        },
     )
 
     # check auth
@@ -35,15 +47,41 @@ async def websocket_client(loop, worker, host, key):
             log.info("Connected to server")
 
             async with connection as ws:
-                task = loop.create_task(worker.read_results(ws.send_json))
+                # healthchecks defined by the server on this connection
+                definitions = dict()
+
+                async def send_results(results):
+                    await ws.send_bytes(protocol.encode_results(results))
+
+                batcher = protocol.Batcher(send_results)
+                task = loop.create_task(worker.read_results(batcher.add_wait))
 
                 try:
                     async for msg in ws:
                         if msg.type == aiohttp.WSMsgType.TEXT:
-                            cls, id, kwargs = msg.json()
-                            worker.enqueue(cls, id, **kwargs)
+                            log.error(
+                                "Server sent JSON; it does not support protocol "
+                                "version %s. Upgrade the server.",
+                                protocol.VERSION,
+                            )
+                            sys.exit(1)
+
+                        if msg.type != aiohttp.WSMsgType.BINARY:
+                            continue
+
+                        kind, records = protocol.decode(msg.data)
+
+                        if kind == protocol.DEFINE:
+                            for number, priority, cls, kwargs in records:
+                                definitions[number] = cls, priority, kwargs
+
+                        elif kind == protocol.DISPATCH:
+                            for number in records:
+                                cls, priority, kwargs = definitions[number]
+                                worker.enqueue(cls, number, priority, **kwargs)
                 finally:
                     task.cancel()
+                    batcher.close()
         except (
             aiohttp.client_exceptions.ClientConnectorError,
             asyncio.TimeoutError,
@@ -56,14 +94,39 @@ async def websocket_client(loop, worker, host, key):
 
 def main():
     # run as executable, must be remote worker
-    if len(sys.argv) < 3:
+    args = sys.argv[1:]
+    threads = getenv("DSPORTAL_THREADS", "")
+
+    if "--threads" in args:
+        i = args.index("--threads")
+        threads = args[i + 1 : i + 2]
+        threads = threads[0] if threads else None
+        del args[i : i + 2]
+
+    if len(args) < 2 or threads is None:
         print(__doc__ % sys.argv[0])
         sys.exit(1)
 
-    host = sys.argv[1]
-    key = sys.argv[2]
-
-    worker = Worker()
+    host = args[0]
+    key = args[1]
+
+    thread_kwargs = dict()
+    if threads:
+        min_threads, _, max_threads = threads.partition(":")
+        thread_kwargs["min_threads"] = int(min_threads)
+        thread_kwargs["max_threads"] = int(max_threads or min_threads)
+
+    process_checks = dict()
+    for spec in getenv("DSPORTAL_PROCESS_CHECKS", "").split(","):
+        if spec:
+            cls, _, deadline = spec.partition(":")
+            process_checks[cls] = deadline or 60
+
+    worker = Worker(
+        process_checks=process_checks,
+        processes=int(getenv("DSPORTAL_PROCESSES", 2)),
+        **thread_kwargs
+    )
     worker.start()
 
     loop = asyncio.get_event_loop()